@@ -29,6 +29,7 @@ setup(
     packages=['sipclient', 'sipclient.configuration'],
     data_files=[('share/sipclients3/sounds', glob.glob(os.path.join('resources', 'sounds', '*.wav'))), ('share/sipclients3/tls', ['resources/tls/ca.crt', 'resources/tls/default.crt'])],
     scripts=[
+        'sip-analyze-rtp3',
         'sip-audio-session3',
         'sip-message3',
         'sip-publish-presence3',
@@ -0,0 +1,150 @@
+
+"""Local store for the history of the messages sent and received"""
+
+__all__ = ['MessageHistory', 'HistoryEntry']
+
+import os
+import sqlite3
+import time
+
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+from application.system import makedirs
+
+
+class HistoryEntry(object):
+    def __init__(self, id, account, peer, direction, timestamp, imdn_id, content_type, content, state):
+        self.id = id
+        self.account = account
+        self.peer = peer
+        self.direction = direction
+        self.timestamp = timestamp
+        self.imdn_id = imdn_id
+        self.content_type = content_type
+        self.content = content
+        self.state = state
+
+
+class MessageHistory(object):
+    """
+    Messages kept in an SQLite database, indexed by peer, time and IMDN
+    Message-ID. The writes are queued and done by a background thread, in
+    batches of up to batch_size rows per transaction, at most flush_interval
+    seconds after they were queued. The state of an outgoing message
+    (queued, sent, delivered, displayed or failed) only moves forward, so
+    late or duplicated notifications do not take it back.
+    """
+
+    # the states an outgoing message can be in before moving to each state
+    _previous_states = {'sent': ('queued', 'failed'),
+                        'failed': ('queued', 'sent'),
+                        'delivered': ('queued', 'sent', 'failed'),
+                        'displayed': ('queued', 'sent', 'failed', 'delivered')}
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        makedirs(os.path.dirname(path))
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, account TEXT, peer TEXT NOT NULL, direction TEXT NOT NULL, '
+                         'timestamp REAL NOT NULL, imdn_id TEXT, content_type TEXT, content TEXT, state TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer, timestamp)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_imdn_id ON messages (imdn_id)')
+        self._lock = Lock()
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name='Message history')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, account, peer, direction, content, content_type='text/plain', imdn_id=None, state=None, timestamp=None):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        row = (str(account) if account is not None else None, peer, direction, timestamp or time.time(), imdn_id, content_type, content, state)
+        self._queue.put(('add', row))
+
+    def update_state(self, imdn_id, state):
+        if imdn_id and state in self._previous_states:
+            self._queue.put(('state', imdn_id, state))
+
+    def fetch(self, peer, callback, limit=20, before=None):
+        """
+        Like query, but read by the background thread once the writes queued
+        before are done. The entries are handed to callback from that thread.
+        """
+        self._queue.put(('fetch', (peer, limit, before), callback))
+
+    def flush(self, timeout=None):
+        """Wait until the queued writes are in the database"""
+        event = Event()
+        self._queue.put(('flush', event))
+        return event.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(5)
+        with self._lock:
+            self._db.close()
+
+    def query(self, peer, limit=20, before=None):
+        """
+        Return up to limit messages exchanged with peer, newest first. To get
+        the next page pass the (timestamp, id) of the last entry as before.
+        """
+        query = 'SELECT id, account, peer, direction, timestamp, imdn_id, content_type, content, state FROM messages WHERE peer = ?'
+        arguments = (peer,)
+        if before is not None:
+            query += ' AND (timestamp < ? OR (timestamp = ? AND id < ?))'
+            arguments += (before[0], before[0], before[1])
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY timestamp DESC, id DESC LIMIT ?', arguments + (limit,)).fetchall()
+        return [HistoryEntry(*row) for row in rows]
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            operations = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(operations) < self.batch_size and operations[-1] is not None and operations[-1][0] not in ('flush', 'fetch'):
+                try:
+                    operations.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            if operations[-1] is None:
+                operations.pop()
+                stopped = True
+            self._write([operation for operation in operations if operation[0] in ('add', 'state')])
+            for operation in operations:
+                if operation[0] == 'flush':
+                    operation[1].set()
+                elif operation[0] == 'fetch':
+                    _, arguments, callback = operation
+                    try:
+                        entries = self.query(*arguments)
+                    except sqlite3.Error:
+                        entries = []
+                    callback(entries)
+
+    def _write(self, operations):
+        if not operations:
+            return
+        with self._lock:
+            try:
+                self._db.execute('BEGIN')
+                for operation in operations:
+                    if operation[0] == 'add':
+                        self._db.execute('INSERT INTO messages (account, peer, direction, timestamp, imdn_id, content_type, content, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', operation[1])
+                    else:
+                        _, imdn_id, state = operation
+                        previous = self._previous_states[state]
+                        self._db.execute('UPDATE messages SET state = ? WHERE imdn_id = ? AND direction = ? AND state IN (%s)' % ', '.join('?' * len(previous)),
+                                         (state, imdn_id, 'outgoing') + previous)
+                self._db.execute('COMMIT')
+            except sqlite3.Error:
+                if self._db.in_transaction:
+                    self._db.execute('ROLLBACK')
@@ -0,0 +1,121 @@
+
+"""Runner for the scripts hooked to call events"""
+
+__all__ = ['HookRunner']
+
+import importlib.util
+import os
+import signal
+import subprocess
+
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic
+
+from twisted.internet import reactor
+
+
+class HookRunner(object):
+    """
+    Runs the hook scripts on up to workers threads, so they neither block
+    the twisted thread nor pile up. A script still running after timeout
+    seconds is terminated together with the processes it started, and every
+    script is waited for so that it does not remain a zombie.
+
+    Next to a script a Python hook with the same name and a .py extension
+    can be used, it is loaded once (and again when it changes) and its
+    run(name) function is called in the worker thread, which avoids the
+    fork/exec cost on frequent events. Python hooks cannot be interrupted,
+    so the timeout does not apply to them.
+
+    Whether a hook exists is remembered for cache_ttl seconds.
+    """
+
+    def __init__(self, workers=4, timeout=30, cache_ttl=5, log=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.log = log
+        self._jobs = Queue()
+        self._threads = []
+        self._lookups = {}
+        self._modules = {}
+        self._lock = Lock()
+
+    def run(self, path):
+        """Run the hook at path, return False if there is no such hook"""
+        kind = self._lookup(path)
+        if kind is None:
+            return False
+        if len(self._threads) < self.workers:
+            thread = Thread(target=self._work, name='Hook runner %d' % (len(self._threads) + 1))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._jobs.put((kind, path))
+        return True
+
+    def stop(self):
+        for thread in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+    def _lookup(self, path):
+        now = monotonic()
+        entry = self._lookups.get(path)
+        if entry is not None and now < entry[1]:
+            return entry[0]
+        if os.path.exists(path):
+            kind = 'script'
+        elif os.path.exists(path + '.py'):
+            kind = 'python'
+        else:
+            kind = None
+        self._lookups[path] = kind, now + self.cache_ttl
+        return kind
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            kind, path = job
+            try:
+                if kind == 'script':
+                    self._run_script(path)
+                else:
+                    self._run_python(path)
+            except Exception as e:
+                self._log('Hook %s failed: %s' % (path, e))
+
+    def _run_script(self, path):
+        # a new session lets us terminate everything the script started
+        process = subprocess.Popen([path], start_new_session=True)
+        try:
+            process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            self._log('Hook %s did not finish in %d seconds, terminating it' % (path, self.timeout))
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+            except ProcessLookupError:
+                process.wait()
+
+    def _run_python(self, path):
+        filename = path + '.py'
+        mtime = os.stat(filename).st_mtime
+        with self._lock:
+            entry = self._modules.get(filename)
+            if entry is None or entry[1] != mtime:
+                spec = importlib.util.spec_from_file_location('sipclient_hook_%x' % abs(hash(filename)), filename)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                entry = self._modules[filename] = module, mtime
+        entry[0].run(os.path.basename(path))
+
+    def _log(self, message):
+        if self.log is not None:
+            reactor.callFromThread(self.log, message)
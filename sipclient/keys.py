@@ -0,0 +1,94 @@
+
+"""Cache for the PGP keys used for message encryption"""
+
+__all__ = ['PGPKeyCache']
+
+import glob
+import os
+
+from threading import Lock, Thread
+from time import monotonic
+
+import pgpy
+
+
+class PGPKeyCache(object):
+    """
+    Parsed PGP keys by file path. A cached key is reused for as long as its
+    file keeps the same mtime and size, so that a key is only parsed again
+    when the file was replaced. Missing or unparsable key files are
+    remembered for negative_ttl seconds, during which they are not even
+    looked up on disk. Whoever writes a key file must call invalidate().
+    """
+
+    def __init__(self, negative_ttl=60, on_load=None):
+        self.negative_ttl = negative_ttl
+        self.on_load = on_load
+        self._keys = {}
+        self._missing = {}
+        self._lock = Lock()
+
+    def get(self, path):
+        """Return the key stored in path or None"""
+        if not path:
+            return None
+        path = str(path)
+        with self._lock:
+            expires = self._missing.get(path)
+            if expires is not None:
+                if monotonic() < expires:
+                    return None
+                del self._missing[path]
+            cached = self._keys.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._forget(path)
+            return None
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        key = self._load(path, stat)
+        if key is not None and self.on_load is not None:
+            self.on_load(path)
+        return key
+
+    def invalidate(self, path):
+        if not path:
+            return
+        with self._lock:
+            self._keys.pop(str(path), None)
+            self._missing.pop(str(path), None)
+
+    def preload(self, directory, callback=None):
+        """Parse the keys in directory in a background thread, then call callback with their number"""
+        thread = Thread(target=self._preload, args=(directory, callback), name='PGP key preload')
+        thread.daemon = True
+        thread.start()
+
+    def _preload(self, directory, callback):
+        count = 0
+        for path in glob.glob(os.path.join(directory, '*.pubkey')) + glob.glob(os.path.join(directory, '*.privkey')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if self._load(path, stat) is not None:
+                count += 1
+        if callback is not None:
+            callback(count)
+
+    def _load(self, path, stat):
+        try:
+            key, _ = pgpy.PGPKey.from_file(path)
+        except Exception:
+            self._forget(path)
+            return None
+        with self._lock:
+            self._keys[path] = ((stat.st_mtime_ns, stat.st_size), key)
+            self._missing.pop(path, None)
+        return key
+
+    def _forget(self, path):
+        with self._lock:
+            self._keys.pop(path, None)
+            self._missing[path] = monotonic() + self.negative_ttl
@@ -0,0 +1,284 @@
+
+"""Multi-process load test support for sip-session3"""
+
+__all__ = ['LoadCoordinator', 'LoadWorkerControl', 'split_capacity']
+
+import json
+import os
+import pty
+import shutil
+import socket
+import subprocess
+import sys
+
+from threading import Lock, Thread
+
+from twisted.internet import reactor
+
+
+def split_capacity(capacity, count):
+    """Spread capacity over count buckets, as evenly as possible"""
+    share, extra = divmod(capacity, count)
+    return [share + (1 if index < extra else 0) for index in range(count)]
+
+
+class _LineChannel(object):
+    """Newline delimited JSON messages over a stream socket"""
+
+    def __init__(self, sock):
+        self.socket = sock
+        self._send_lock = Lock()
+
+    def send(self, **message):
+        data = (json.dumps(message) + '\n').encode()
+        with self._send_lock:
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                pass
+
+    def receive(self):
+        buffer = b''
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                return
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                try:
+                    yield json.loads(line.decode())
+                except ValueError:
+                    continue
+
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class LoadWorkerControl(object):
+    """
+    Worker side of the control channel. Runs inside a sip-session3 process
+    started with --load-worker and delivers the coordinator commands to
+    handler in the twisted thread.
+    """
+
+    def __init__(self, fd, handler):
+        self.channel = _LineChannel(socket.socket(fileno=fd))
+        self.handler = handler
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='Load worker control')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, **message):
+        self.channel.send(**message)
+
+    def _run(self):
+        for message in self.channel.receive():
+            reactor.callFromThread(self.handler, message)
+        # the coordinator went away, there is nothing left to do for us
+        reactor.callFromThread(self.handler, {'command': 'quit'})
+
+
+class LoadWorker(object):
+    """Coordinator side handle for one worker process"""
+
+    def __init__(self, index, directory):
+        self.index = index
+        self.directory = directory
+        self.process = None
+        self.channel = None
+        self.capacity = 0
+        self.started = False
+        self.stats = {}
+
+    @property
+    def active(self):
+        return self.stats.get('active', 0)
+
+    def start(self, command):
+        parent_socket, child_socket = socket.socketpair()
+        master_fd, slave_fd = pty.openpty()
+        command = command + ['--load-worker', str(child_socket.fileno())]
+        try:
+            self.process = subprocess.Popen(command, stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, pass_fds=(child_socket.fileno(),), start_new_session=True, close_fds=True)
+        finally:
+            os.close(slave_fd)
+            child_socket.close()
+        self.channel = _LineChannel(parent_socket)
+        # The worker runs the regular terminal UI on a pseudo-terminal. Its
+        # output must be drained or the worker blocks, keep it for debugging.
+        console = Thread(target=self._drain_console, args=(master_fd,), name='Load worker %d console' % self.index)
+        console.daemon = True
+        console.start()
+
+    def send(self, **message):
+        if self.channel is not None:
+            self.channel.send(**message)
+
+    def receive(self):
+        return self.channel.receive()
+
+    def terminate(self):
+        if self.process is None:
+            return
+        try:
+            self.process.terminate()
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        except OSError:
+            pass
+        self.channel.close()
+        self.process = None
+
+    def _drain_console(self, fd):
+        try:
+            with open(os.path.join(self.directory, 'console.log'), 'ab') as log_file:
+                while True:
+                    try:
+                        data = os.read(fd, 65536)
+                    except OSError:
+                        break
+                    if not data:
+                        break
+                    log_file.write(data)
+        finally:
+            os.close(fd)
+
+
+class LoadCoordinator(object):
+    """
+    Spreads a /load test over several sip-session3 worker processes, each
+    one with its own engine, configuration directory copy and local port
+    range, so that the number of legs scales with the number of cores.
+
+    Every worker runs the regular single process load test on its share of
+    the capacity and reports its counters back, the coordinator merges them.
+    """
+
+    stat_names = ('active', 'started', 'established', 'failed', 'ended')
+
+    def __init__(self, account, config_directory, workers, report):
+        self.account = account
+        self.config_directory = config_directory
+        self.workers_directory = os.path.join(config_directory, 'load-workers')
+        self.count = workers
+        self.report = report
+        self.workers = []
+        self.target = None
+        self.soundfile = None
+        self._teardown_call = None
+
+    @property
+    def running(self):
+        return bool(self.workers)
+
+    def start(self, target, capacity, timeout, soundfile=None):
+        self.target = target
+        self.soundfile = soundfile
+        for index in range(self.count):
+            worker = LoadWorker(index, os.path.join(self.workers_directory, str(index)))
+            self._prepare_directory(worker.directory)
+            worker.start(self._worker_command(index))
+            self.workers.append(worker)
+            thread = Thread(target=self._read_worker, args=(worker,), name='Load worker %d' % index)
+            thread.daemon = True
+            thread.start()
+        shares = split_capacity(capacity, self.count)
+        for worker, share in zip(self.workers, shares):
+            self._grow(worker, share)
+        # The workers ramp up in parallel, so the hold time is counted by the
+        # coordinator from the moment the biggest share has been started.
+        if timeout > 0:
+            self._teardown_call = reactor.callLater(max(shares) + timeout, self.stop)
+
+    def add(self, count):
+        # fill up the least loaded workers first
+        added = dict((worker, 0) for worker in self.workers)
+        for _ in range(count):
+            worker = min(self.workers, key=lambda w: w.capacity + added[w])
+            added[worker] += 1
+        for worker, n in added.items():
+            self._grow(worker, n)
+
+    def remove(self, count):
+        # take the legs from the most loaded workers first
+        removed = dict((worker, 0) for worker in self.workers)
+        for _ in range(count):
+            worker = max(self.workers, key=lambda w: w.active - removed[w])
+            if worker.active - removed[worker] <= 0:
+                break
+            removed[worker] += 1
+        for worker, n in removed.items():
+            if n:
+                worker.capacity = max(0, worker.capacity - n)
+                worker.send(command='remove', count=n)
+
+    def stop(self):
+        if self._teardown_call is not None and self._teardown_call.active():
+            self._teardown_call.cancel()
+        self._teardown_call = None
+        self.report('Load test: stopping %d worker(s)' % len(self.workers))
+        for worker in self.workers:
+            worker.send(command='stop')
+            worker.send(command='quit')
+        workers, self.workers = self.workers, []
+        # give the workers a chance to hang up their legs before killing them
+        reactor.callLater(10, self._terminate, workers)
+
+    def stats(self):
+        merged = dict.fromkeys(self.stat_names, 0)
+        for worker in self.workers:
+            for name in self.stat_names:
+                merged[name] += worker.stats.get(name, 0)
+        return merged
+
+    def _grow(self, worker, count):
+        if not count:
+            return
+        worker.capacity += count
+        if worker.started:
+            worker.send(command='add', count=count)
+        else:
+            worker.send(command='start', target=self.target, capacity=count, timeout=0, soundfile=self.soundfile)
+            worker.started = True
+
+    def _terminate(self, workers):
+        for worker in workers:
+            worker.terminate()
+
+    def _prepare_directory(self, directory):
+        def ignore(path, names):
+            if os.path.realpath(path) == os.path.realpath(self.config_directory):
+                return [name for name in names if name in ('load-workers', 'logs', 'history', 'spool', 'cache')]
+            return []
+        shutil.copytree(self.config_directory, directory, ignore=ignore, dirs_exist_ok=True)
+
+    def _worker_command(self, index):
+        return [sys.executable, os.path.realpath(sys.argv[0]),
+                '--config-directory', os.path.join(self.workers_directory, str(index)),
+                '--account', str(self.account.id),
+                '--disable-sound',
+                '--load-worker-slot', '%d/%d' % (index, self.count)]
+
+    def _read_worker(self, worker):
+        for message in worker.receive():
+            reactor.callFromThread(self._handle_message, worker, message)
+        reactor.callFromThread(self._handle_message, worker, {'event': 'exited'})
+
+    def _handle_message(self, worker, message):
+        event = message.get('event')
+        if event == 'stats':
+            worker.stats.update(message.get('stats', {}))
+        elif event == 'exited':
+            if worker in self.workers:
+                self.report('Load test: worker %d exited' % worker.index)
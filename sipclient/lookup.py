@@ -0,0 +1,147 @@
+
+"""Process wide cache of the routes found by SIP proxy DNS lookups"""
+
+__all__ = ['RouteCache', 'CachedDNSLookup', 'lookup_target']
+
+import re
+
+from time import monotonic
+
+from application.notification import NotificationCenter, NotificationData
+from application.python.types import Singleton
+from eventlib import coros
+
+from sipsimple.account import Account, BonjourAccount
+from sipsimple.core import SIPURI
+from sipsimple.lookup import DNSLookup, DNSLookupError
+from sipsimple.threading.green import run_in_green_thread
+
+
+def lookup_target(account, target):
+    """Return the (uri, tls_name) that must be looked up to reach the target SIPURI from account"""
+    if isinstance(account, Account) and account.sip.outbound_proxy is not None:
+        uri = SIPURI(host=account.sip.outbound_proxy.host, port=account.sip.outbound_proxy.port, parameters={'transport': account.sip.outbound_proxy.transport})
+        tls_name = account.sip.tls_name or account.sip.outbound_proxy.host
+    elif isinstance(account, Account) and account.sip.always_use_my_proxy:
+        uri = SIPURI(host=account.id.domain)
+        tls_name = account.sip.tls_name or account.id.domain
+    else:
+        uri = target
+        tls_name = uri.host
+        if account is not BonjourAccount():
+            if account.id.domain == uri.host.decode():
+                tls_name = account.sip.tls_name or account.id.domain
+            elif "isfocus" in str(uri) and uri.host.decode().endswith(account.id.domain):
+                tls_name = account.conference.tls_name or account.sip.tls_name or account.id.domain
+        else:
+            is_ip_address = re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", uri.host.decode()) or ":" in uri.host.decode()
+            if "isfocus" in str(uri) and account.conference.tls_name:
+                tls_name = account.conference.tls_name
+            elif is_ip_address and account.sip.tls_name:
+                tls_name = account.sip.tls_name
+    return uri, tls_name
+
+
+class RouteCache(object, metaclass=Singleton):
+    """
+    Keeps the routes found by DNSLookup.lookup_sip_proxy for ttl seconds.
+    After that they are still handed out for up to stale_ttl seconds, while
+    a new lookup refreshes them in the background, and they are also kept
+    when that lookup fails. Concurrent lookups of the same target share one
+    DNS query and failures are remembered for negative_ttl seconds.
+
+    DNSLookup does not expose the TTLs of the records it used, so a fixed
+    ttl is applied to all of them.
+    """
+
+    def __init__(self, ttl=300, stale_ttl=3600, negative_ttl=10):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self._routes = {}
+        self._failures = {}
+        self._waiters = {}
+
+    @staticmethod
+    def _key(uri, transport_list, tls_name):
+        # the user part does not change where a request goes
+        return uri.host, uri.port, uri.parameters.get('transport'), uri.secure, tuple(transport_list), tls_name
+
+    @run_in_green_thread
+    def lookup(self, uri, transport_list, tls_name, callback):
+        """Find the routes for uri and call callback(routes, error) with them from the twisted thread"""
+        key = self._key(uri, transport_list, tls_name)
+        now = monotonic()
+        entry = self._routes.get(key)
+        if entry is not None:
+            routes, expires = entry
+            if now < expires + self.stale_ttl:
+                callback(list(routes), None)
+                if now >= expires:
+                    self._lookup(key, uri, transport_list, tls_name, None)
+                return
+            del self._routes[key]
+        failure = self._failures.get(key)
+        if failure is not None:
+            error, expires = failure
+            if now < expires:
+                callback(None, error)
+                return
+            del self._failures[key]
+        self._lookup(key, uri, transport_list, tls_name, callback)
+
+    def warm(self, uri, transport_list, tls_name):
+        """Resolve uri ahead of time, so that the first request to it does not wait for DNS"""
+        self.lookup(uri, transport_list, tls_name, lambda routes, error: None)
+
+    def clear(self):
+        self._routes.clear()
+        self._failures.clear()
+
+    def _lookup(self, key, uri, transport_list, tls_name, callback):
+        if key in self._waiters:
+            if callback is not None:
+                self._waiters[key].append(callback)
+            return
+        self._waiters[key] = [callback] if callback is not None else []
+        try:
+            routes = DNSLookup().lookup_sip_proxy(uri, transport_list, tls_name=tls_name).wait()
+        except DNSLookupError as e:
+            routes, error = None, str(e)
+            entry = self._routes.get(key)
+            if entry is not None and monotonic() < entry[1] + self.stale_ttl:
+                # a failed refresh keeps serving the routes we already had
+                routes, error = entry[0], None
+            else:
+                self._failures[key] = error, monotonic() + self.negative_ttl
+        else:
+            error = None
+            self._routes[key] = routes, monotonic() + self.ttl
+            self._failures.pop(key, None)
+        # callers consume the routes they get, each of them needs its own list
+        for callback in self._waiters.pop(key):
+            callback(list(routes) if routes is not None else None, error)
+
+
+class CachedDNSLookup(object):
+    """
+    Drop-in replacement for DNSLookup when only lookup_sip_proxy is used:
+    the result comes from the RouteCache and is posted as a
+    DNSLookupDidSucceed or DNSLookupDidFail notification with this object
+    as the sender, just like DNSLookup does. Like DNSLookup it also returns
+    an event, whose wait() returns the routes or raises DNSLookupError.
+    """
+
+    def lookup_sip_proxy(self, uri, transport_list, tls_name=None):
+        event = coros.event()
+        RouteCache().lookup(uri, transport_list, tls_name, lambda routes, error: self._lookup_finished(event, routes, error))
+        return event
+
+    def _lookup_finished(self, event, routes, error):
+        notification_center = NotificationCenter()
+        if error is None:
+            notification_center.post_notification('DNSLookupDidSucceed', sender=self, data=NotificationData(result=routes))
+            event.send(routes)
+        else:
+            notification_center.post_notification('DNSLookupDidFail', sender=self, data=NotificationData(error=error))
+            event.send(exc=DNSLookupError(error))
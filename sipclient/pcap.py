@@ -0,0 +1,373 @@
+
+"""Packet capture support: a shared tcpdump ring and per-call pcap splitting"""
+
+__all__ = ['PcapReader', 'PcapWriter', 'CallCapture', 'CaptureRing', 'decode_packet', 'split_captures']
+
+import glob
+import os
+import socket
+import struct
+import subprocess
+import time
+
+from threading import Condition, Lock, Thread
+
+from application.system import makedirs
+
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+
+
+class PcapReader(object):
+    """Iterates over the (timestamp, data, original_length) records of a pcap file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        header = self.file.read(24)
+        if len(header) < 24:
+            self.file.close()
+            raise ValueError('%s: truncated pcap header' % path)
+        for byte_order in ('<', '>'):
+            magic, = struct.unpack(byte_order + 'I', header[:4])
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NANOSECONDS):
+                break
+        else:
+            self.file.close()
+            raise ValueError('%s: not a pcap file' % path)
+        self.byte_order = byte_order
+        self.resolution = 1e-9 if magic == PCAP_MAGIC_NANOSECONDS else 1e-6
+        self.version_major, self.version_minor, _, _, self.snaplen, self.linktype = struct.unpack(byte_order + 'HHiIII', header[4:])
+        self.linktype &= 0x0fffffff
+        self._record = struct.Struct(byte_order + 'IIII')
+
+    def __iter__(self):
+        read, record, resolution = self.file.read, self._record, self.resolution
+        while True:
+            header = read(16)
+            if len(header) < 16:
+                return
+            seconds, fraction, captured_length, original_length = record.unpack(header)
+            data = read(captured_length)
+            if len(data) < captured_length:
+                # tcpdump is still writing this one
+                return
+            yield seconds + fraction * resolution, data, original_length
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PcapWriter(object):
+    """Writes records to a microsecond resolution pcap file"""
+
+    def __init__(self, path, linktype, snaplen=262144):
+        self.file = open(path, 'wb')
+        self.file.write(struct.pack('<IHHiIII', PCAP_MAGIC, 2, 4, 0, 0, snaplen, linktype))
+        self.count = 0
+
+    def write(self, timestamp, data, original_length=None):
+        seconds = int(timestamp)
+        microseconds = int(round((timestamp - seconds) * 1e6))
+        if microseconds == 1000000:
+            seconds, microseconds = seconds + 1, 0
+        self.file.write(struct.pack('<IIII', seconds, microseconds, len(data), original_length or len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _network_offset(linktype, data):
+    """Return (ethertype, offset of the network header) for a link layer frame"""
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None, None
+        ethertype, offset = struct.unpack_from('!H', data, 12)[0], 14
+        while ethertype in (0x8100, 0x88a8) and len(data) >= offset + 4:
+            ethertype, offset = struct.unpack_from('!H', data, offset + 2)[0], offset + 4
+        return ethertype, offset
+    elif linktype == LINKTYPE_LINUX_SLL:
+        return (struct.unpack_from('!H', data, 14)[0], 16) if len(data) >= 16 else (None, None)
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        return (struct.unpack_from('!H', data, 0)[0], 20) if len(data) >= 20 else (None, None)
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if len(data) < 4:
+            return None, None
+        family = struct.unpack_from('<I' if linktype == LINKTYPE_NULL else '!I', data, 0)[0]
+        if family > 0xffff:
+            family = struct.unpack_from('>I', data, 0)[0]
+        return (0x0800 if family == 2 else 0x86dd), 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return (0x0800 if data and data[0] >> 4 == 4 else 0x86dd), 0
+    return None, None
+
+
+def decode_packet(linktype, data):
+    """
+    Return (protocol, source, source_port, destination, destination_port,
+    payload) for an UDP or TCP packet or None for anything else. Protocol is
+    'udp' or 'tcp', the addresses are strings.
+    """
+    ethertype, offset = _network_offset(linktype, data)
+    if ethertype == 0x0800 and len(data) >= offset + 20:
+        header_length = (data[offset] & 0x0f) * 4
+        fragment = struct.unpack_from('!H', data, offset + 6)[0]
+        if fragment & 0x1fff:
+            return None
+        protocol = data[offset + 9]
+        source = socket.inet_ntop(socket.AF_INET, data[offset+12:offset+16])
+        destination = socket.inet_ntop(socket.AF_INET, data[offset+16:offset+20])
+        offset += header_length
+    elif ethertype == 0x86dd and len(data) >= offset + 40:
+        protocol = data[offset + 6]
+        source = socket.inet_ntop(socket.AF_INET6, data[offset+8:offset+24])
+        destination = socket.inet_ntop(socket.AF_INET6, data[offset+24:offset+40])
+        offset += 40
+    else:
+        return None
+    if protocol == 17 and len(data) >= offset + 8:
+        source_port, destination_port = struct.unpack_from('!HH', data, offset)
+        return 'udp', source, source_port, destination, destination_port, data[offset+8:]
+    elif protocol == 6 and len(data) >= offset + 20:
+        source_port, destination_port = struct.unpack_from('!HH', data, offset)
+        header_length = (data[offset + 12] >> 4) * 4
+        return 'tcp', source, source_port, destination, destination_port, data[offset+header_length:]
+    return None
+
+
+class CallCapture(object):
+    """
+    The packets of one call to be cut from the capture files into output.
+    Media packets are matched by the call's local and remote RTP/RTCP ports,
+    signaling packets by their Call-ID, all of them within the call's time
+    window (plus margin). The callback gets the packet count or the error.
+    """
+
+    def __init__(self, output, media_ports, signaling_ports, call_id, start, end, callback, margin=2.0):
+        self.output = output
+        self.media_ports = set(media_ports)
+        self.signaling_ports = set(signaling_ports)
+        self.call_id = call_id.encode() if call_id else None
+        self.start = start - margin
+        self.end = end + margin
+        self.callback = callback
+        self.count = 0
+        self._writer = None
+
+    def matches(self, timestamp, packet):
+        if not self.start <= timestamp <= self.end:
+            return False
+        protocol, source, source_port, destination, destination_port, payload = packet
+        if source_port in self.signaling_ports or destination_port in self.signaling_ports:
+            return self.call_id is not None and self.call_id in payload
+        return source_port in self.media_ports or destination_port in self.media_ports
+
+    def write(self, reader, timestamp, data, original_length):
+        if self._writer is None:
+            self._writer = PcapWriter(self.output, reader.linktype, reader.snaplen)
+        self._writer.write(timestamp, data, original_length)
+        self.count += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def split_captures(files, captures):
+    """
+    Copy the packets of the captures from the capture files in a single
+    pass. Files last written before the earliest call window are not read,
+    and a file is left as soon as its packets are past the latest one, so
+    a file that starts after it costs only its headers.
+    """
+    start = min(capture.start for capture in captures)
+    end = max(capture.end for capture in captures)
+    try:
+        for path in files:
+            try:
+                if os.stat(path).st_mtime < start:
+                    continue
+                reader = PcapReader(path)
+            except (OSError, ValueError):
+                continue
+            with reader:
+                for timestamp, data, original_length in reader:
+                    if timestamp < start:
+                        continue
+                    if timestamp > end:
+                        break
+                    packet = decode_packet(reader.linktype, data)
+                    if packet is None:
+                        continue
+                    for capture in captures:
+                        if capture.matches(timestamp, packet):
+                            capture.write(reader, timestamp, data, original_length)
+    finally:
+        for capture in captures:
+            capture.close()
+
+
+class CaptureRing(object):
+    """
+    A single tcpdump process which captures the SIP and RTP traffic of the
+    whole process into a ring of files, from which the per-call captures
+    are cut after the calls end. The process is started in a thread and the
+    outcome is reported through the report callback from that thread.
+
+    The captures are cut by one background thread once the margin after a
+    call has passed, so its last packets are in the ring, and all the calls
+    that are due by then are cut in the same pass over the files.
+    """
+
+    def __init__(self, directory, report, file_size=100, file_count=10):
+        self.directory = directory
+        self.report = report
+        self.file_size = file_size
+        self.file_count = file_count
+        self.process = None
+        self.stopped = False
+        self._lock = Lock()
+        self._captures = []
+        self._split_condition = Condition()
+        self._split_thread = None
+
+    @property
+    def prefix(self):
+        return os.path.join(self.directory, 'ring.pcap')
+
+    @property
+    def log(self):
+        return os.path.join(self.directory, 'tcpdump.log')
+
+    @property
+    def files(self):
+        """The ring files, oldest first"""
+        def mtime(path):
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return 0
+        return sorted(glob.glob(self.prefix + '*'), key=mtime)
+
+    def start(self, capture_filter):
+        thread = Thread(target=self._run, args=(capture_filter,), name='Capture ring')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            process, self.process = self.process, None
+        with self._split_condition:
+            # cut what is still waiting from what was captured so far
+            self._split_condition.notify()
+        if process is None:
+            return
+        # SIGINT propagates through sudo and lets tcpdump flush its buffers
+        try:
+            process.send_signal(2)
+            process.wait(timeout=3.0)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        except OSError:
+            pass
+
+    def split(self, output, media_ports, signaling_ports, call_id, start, end, callback):
+        """Cut the capture of a call in the background and hand the packet count to callback"""
+        with self._split_condition:
+            self._captures.append(CallCapture(output, media_ports, signaling_ports, call_id, start, end, callback))
+            if self._split_thread is None:
+                self._split_thread = Thread(target=self._split, name='Capture split')
+                self._split_thread.daemon = True
+                self._split_thread.start()
+            self._split_condition.notify()
+
+    def _split(self):
+        while True:
+            with self._split_condition:
+                while True:
+                    now = time.time()
+                    captures = [capture for capture in self._captures if self.stopped or capture.end <= now]
+                    if captures:
+                        break
+                    self._split_condition.wait(min(capture.end for capture in self._captures) - now if self._captures else None)
+                for capture in captures:
+                    self._captures.remove(capture)
+            try:
+                split_captures(self.files, captures)
+            except Exception as e:
+                for capture in captures:
+                    capture.callback(e)
+            else:
+                for capture in captures:
+                    capture.callback(capture.count)
+
+    def _spawn(self, command):
+        # stderr goes to a file, a pipe that nobody reads would block tcpdump once it is full
+        with open(self.log, 'wb') as log:
+            try:
+                return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=log)
+            except FileNotFoundError:
+                return None
+
+    def _failed(self, process):
+        # tcpdump exits right away when it cannot capture (permissions, bad interface, ...)
+        try:
+            process.wait(timeout=0.5)
+        except subprocess.TimeoutExpired:
+            return None
+        try:
+            with open(self.log, 'rb') as log:
+                return log.read().decode('utf-8', 'replace').strip() or '<no output>'
+        except OSError:
+            return '<no output>'
+
+    def _run(self, capture_filter):
+        makedirs(self.directory)
+        command = ['tcpdump', '-i', 'any', '-U', '-n', '-w', self.prefix, '-C', str(self.file_size), '-W', str(self.file_count), capture_filter]
+        process = self._spawn(command)
+        if process is None:
+            self.report('pcap: tcpdump not found in PATH; install it to capture traffic')
+            return
+        error = self._failed(process)
+        if error is not None and any(text in error.lower() for text in ('permission denied', 'operation not permitted', 'no permission')):
+            # only non-interactive sudo, a password prompt would never be answered
+            process = self._spawn(['sudo', '-n'] + command)
+            error = self._failed(process) if process is not None else error
+        if error is not None:
+            self.report('pcap: capture did not start: %s. To enable: add a NOPASSWD sudoers rule for tcpdump, '
+                        'or `sudo chmod o+r /dev/bpf*`, or install Wireshark ChmodBPF.' % error)
+            return
+        with self._lock:
+            if not self.stopped:
+                self.process = process
+                process = None
+        if process is not None:
+            process.terminate()
+            return
+        self.report('pcap: capturing to a ring of %d x %dMB files in %s' % (self.file_count, self.file_size, self.directory))
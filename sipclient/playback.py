@@ -0,0 +1,152 @@
+
+"""Scheduling of the recordings found in the playback spool"""
+
+__all__ = ['Recording', 'PlaybackQueue', 'parse_recording_name']
+
+import json
+import os
+import time
+
+from collections import deque
+
+
+def parse_recording_name(filename):
+    """
+    Return the (target, priority) encoded in the name of a recording, which
+    is either user@domain.wav or user@domain~N.wav for priority N. A +N
+    suffix, as in user@domain+2.wav, numbers the parts of a recording that
+    is played while it is made and is ignored.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    user, at, domain = name.rpartition('@')
+    domain, separator, part = domain.rpartition('+')
+    if separator and part.isdigit():
+        # a domain never contains a +, a user part may
+        name = user + at + domain
+    target, separator, priority = name.rpartition('~')
+    if separator:
+        try:
+            return target, int(priority)
+        except ValueError:
+            pass
+    return name, 0
+
+
+class Recording(object):
+    def __init__(self, target, filename, priority=0, created=None, max_age=None):
+        self.target = target
+        self.filename = filename
+        self.priority = priority
+        self.created = created if created is not None else time.time()
+        self.max_age = max_age
+        self.queued = time.monotonic()
+        self.started = None
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Create the recording for the wav file at path. A sidecar path + '.json'
+        file may override the target, the priority and the max_age of the
+        recording, it must be written before the wav file.
+        """
+        target, priority = parse_recording_name(path)
+        max_age = None
+        try:
+            with open(path + '.json') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            pass
+        else:
+            if isinstance(metadata, dict):
+                target = metadata.get('target', target)
+                try:
+                    priority = int(metadata.get('priority', priority))
+                except (TypeError, ValueError):
+                    # one that is not a number leaves the priority of the name
+                    pass
+                max_age = metadata.get('max_age')
+        try:
+            created = os.path.getmtime(path)
+        except OSError:
+            created = None
+        return cls(target, path, priority, created, max_age)
+
+    @property
+    def wait_time(self):
+        return (self.started or time.monotonic()) - self.queued
+
+
+class PlaybackQueue(object):
+    """
+    Recordings waiting to be played. Up to max_calls of them are played at
+    the same time, but never two to the same target, whose recordings are
+    played in the order they were added. Among the targets that can be
+    called the one whose next recording has the highest priority goes
+    first, then the one with the oldest recording. Recordings older than
+    max_age seconds (or their own max_age) are expired instead of played.
+    """
+
+    def __init__(self, max_calls=1, max_age=None):
+        self.max_calls = max_calls
+        self.max_age = max_age
+        self.active = {}
+        self.dispatched = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._targets = {}
+
+    def __len__(self):
+        return sum(len(recordings) for recordings in self._targets.values())
+
+    def add(self, recording):
+        self._targets.setdefault(recording.target, deque()).append(recording)
+
+    def next(self):
+        """Return the next recording to be played or None if it must wait"""
+        if len(self.active) >= self.max_calls:
+            return None
+        candidates = [recordings[0] for target, recordings in self._targets.items() if target not in self.active]
+        if not candidates:
+            return None
+        recording = min(candidates, key=lambda item: (-item.priority, item.created, item.queued))
+        recordings = self._targets[recording.target]
+        recordings.popleft()
+        if not recordings:
+            del self._targets[recording.target]
+        recording.started = time.monotonic()
+        self.active[recording.target] = recording
+        self.dispatched += 1
+        self.total_wait += recording.wait_time
+        self.max_wait = max(self.max_wait, recording.wait_time)
+        return recording
+
+    def finished(self, recording):
+        if self.active.get(recording.target) is recording:
+            del self.active[recording.target]
+
+    def expire(self, now=None):
+        """Remove and return the recordings that are too old to be played"""
+        now = now if now is not None else time.time()
+        expired = []
+        for target, recordings in list(self._targets.items()):
+            for recording in list(recordings):
+                max_age = recording.max_age if recording.max_age is not None else self.max_age
+                if max_age and now - recording.created > max_age:
+                    recordings.remove(recording)
+                    expired.append(recording)
+            if not recordings:
+                del self._targets[target]
+        self.expired += len(expired)
+        return expired
+
+    def statistics(self):
+        waiting = [recording for recordings in self._targets.values() for recording in recordings]
+        return dict(queued=len(waiting),
+                    targets=len(self._targets),
+                    active=len(self.active),
+                    dispatched=self.dispatched,
+                    expired=self.expired,
+                    average_wait=self.total_wait / self.dispatched if self.dispatched else 0.0,
+                    max_wait=self.max_wait,
+                    oldest_wait=max((recording.wait_time for recording in waiting), default=0.0))
@@ -0,0 +1,84 @@
+
+"""Thread pool which hands the results back to the reactor in order per key"""
+
+__all__ = ['OrderedWorkerPool']
+
+import os
+
+from queue import Queue
+from threading import Lock, Thread
+
+from twisted.internet import reactor
+
+
+class _KeyState(object):
+    def __init__(self):
+        self.submitted = 0
+        self.delivered = 0
+        self.results = {}
+
+
+class OrderedWorkerPool(object):
+    """
+    Runs blocking or CPU heavy jobs (like PGP encryption) on a bounded set
+    of threads. Jobs submitted with the same key may run in parallel, but
+    their callbacks are called in the twisted thread in submission order,
+    so for example the messages of one conversation keep their order.
+
+    The callback is called with (result, error), error being None when the
+    job succeeded.
+    """
+
+    def __init__(self, workers=None, name='Worker'):
+        self.workers = workers or min(8, os.cpu_count() or 2)
+        self.name = name
+        self._jobs = Queue()
+        self._keys = {}
+        self._lock = Lock()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = Thread(target=self._run, name='%s %d' % (self.name, index + 1))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for thread in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+    def run(self, key, function, *args, callback):
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = _KeyState()
+            sequence = state.submitted
+            state.submitted += 1
+        self._jobs.put((key, sequence, function, args, callback))
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            key, sequence, function, args, callback = job
+            try:
+                outcome = (function(*args), None)
+            except Exception as e:
+                outcome = (None, e)
+            self._deliver(key, sequence, callback, outcome)
+
+    def _deliver(self, key, sequence, callback, outcome):
+        # Scheduling the callbacks while holding the lock keeps them ordered
+        # even when two workers finish jobs of the same key at the same time.
+        with self._lock:
+            state = self._keys[key]
+            state.results[sequence] = (callback, outcome)
+            while state.delivered in state.results:
+                callback, (result, error) = state.results.pop(state.delivered)
+                state.delivered += 1
+                reactor.callFromThread(callback, result, error)
+            if state.delivered == state.submitted:
+                del self._keys[key]
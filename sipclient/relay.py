@@ -0,0 +1,183 @@
+
+"""Live audio sent by va-recorder to be played into calls"""
+
+__all__ = ['LiveAudio', 'LiveWaveFile', 'LiveRelayServer']
+
+import json
+import os
+import socket
+import struct
+
+from threading import Thread
+
+from twisted.internet import reactor
+
+
+class LiveAudio(object):
+    """
+    One transmission of 16 bit mono PCM for target, buffered until it is
+    played. It is only used from the twisted thread.
+    """
+
+    def __init__(self, target, rate, id=None):
+        self.target = target
+        self.rate = rate
+        self.id = id
+        self.buffer = bytearray()
+        self.received = 0
+        self.ended = False
+        self.discarded = False
+
+    @property
+    def buffered(self):
+        """The duration of the buffered audio in seconds"""
+        return len(self.buffer) / 2.0 / self.rate
+
+    def discard(self):
+        """Drop the buffered audio and whatever still arrives"""
+        self.discarded = True
+        self.buffer.clear()
+
+    def read(self):
+        """Remove and return the buffered audio"""
+        # a sample split between two reads stays in the buffer
+        size = len(self.buffer) - len(self.buffer) % 2
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class LiveWaveFile(object):
+    """
+    A 16 bit mono wav file of a fixed duration that is silent where nothing
+    was written yet. One player plays it from the start while the relayed
+    audio is written into it ahead of what the player has read, so the
+    audio plays as one continuous stream.
+    """
+
+    # the player reads the file in blocks of this many bytes ahead of what
+    # it plays, audio written inside such a block is not heard
+    read_ahead = 4000
+
+    def __init__(self, path, rate, duration=3600):
+        self.path = path
+        self.rate = rate
+        self.size = int(duration * rate) * 2
+        self.position = 0
+        self.file = open(path, 'wb')
+        self.file.write(struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + self.size, b'WAVE', b'fmt ', 16, 1, 1, rate, rate * 2, 2, 16, b'data', self.size))
+        # the rest of the file is sparse until it is written
+        self.file.truncate(44 + self.size)
+        self.file.flush()
+
+    @property
+    def duration(self):
+        """The duration of the audio written so far in seconds"""
+        return self.position / 2.0 / self.rate
+
+    def write(self, data, offset=0):
+        """Append data, at offset bytes into the audio if that is further along"""
+        if offset > self.position:
+            self.position = offset - offset % 2
+        data = data[:max(self.size - self.position, 0)]
+        self.file.seek(44 + self.position)
+        self.file.write(data)
+        self.file.flush()
+        self.position += len(data)
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class LiveRelayServer(object):
+    """
+    Accepts va-recorder connections on a UNIX socket. A connection starts
+    with a JSON line with the target, the sample rate and the id of the
+    transmission, followed by 16 bit mono PCM until it is closed. A
+    connection with just a {"id": id, "cancel": true} line cancels that
+    transmission. The live_audio_started(audio), live_audio_received(audio),
+    live_audio_ended(audio) and live_audio_cancelled(id) methods of the
+    handler are called from the twisted thread.
+    """
+
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        self._socket = None
+
+    def start(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        self._socket.listen(5)
+        thread = Thread(target=self._accept, name='Live relay')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _accept(self):
+        sock = self._socket
+        while True:
+            try:
+                connection, _ = sock.accept()
+            except OSError:
+                break
+            thread = Thread(target=self._read, args=(connection,), name='Live relay connection')
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, connection):
+        with connection:
+            data = b''
+            while b'\n' not in data:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            header, data = data.split(b'\n', 1)
+            try:
+                header = json.loads(header.decode())
+                if header.get('cancel'):
+                    reactor.callFromThread(self.handler.live_audio_cancelled, header['id'])
+                    return
+                audio = LiveAudio(header['target'], int(header.get('rate', 16000)), header.get('id'))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return
+            reactor.callFromThread(self.handler.live_audio_started, audio)
+            while data:
+                reactor.callFromThread(self._received, audio, data)
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    break
+            reactor.callFromThread(self._ended, audio)
+
+    def _received(self, audio, data):
+        if audio.discarded:
+            return
+        audio.buffer.extend(data)
+        audio.received += len(data)
+        self.handler.live_audio_received(audio)
+
+    def _ended(self, audio):
+        if audio.discarded:
+            return
+        if len(audio.buffer) % 2:
+            del audio.buffer[-1]
+        audio.ended = True
+        self.handler.live_audio_ended(audio)
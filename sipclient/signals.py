@@ -0,0 +1,171 @@
+
+"""Synthetic audio signals for load tests"""
+
+__all__ = ['SignalSpec', 'SignalCache', 'generate']
+
+import hashlib
+import json
+import os
+import tempfile
+import wave
+
+import numpy as np
+
+from application.system import makedirs
+
+
+# Bump when a generator changes its output, so stale cache entries are not reused
+VERSION = 1
+
+DTMF_FREQUENCIES = {'1': (697, 1209), '2': (697, 1336), '3': (697, 1477), 'A': (697, 1633),
+                    '4': (770, 1209), '5': (770, 1336), '6': (770, 1477), 'B': (770, 1633),
+                    '7': (852, 1209), '8': (852, 1336), '9': (852, 1477), 'C': (852, 1633),
+                    '*': (941, 1209), '0': (941, 1336), '#': (941, 1477), 'D': (941, 1633)}
+
+
+def _dbfs(level):
+    return 10 ** (level / 20.0)
+
+
+def white_noise(rate, duration, random):
+    return random.uniform(-1.0, 1.0, int(rate * duration))
+
+
+def pink_noise(rate, duration, random):
+    # shape white noise with a 1/f power spectrum in the frequency domain
+    count = int(rate * duration)
+    spectrum = np.fft.rfft(random.standard_normal(count))
+    frequencies = np.fft.rfftfreq(count, 1.0 / rate)
+    frequencies[0] = frequencies[1] if count > 1 else 1.0
+    samples = np.fft.irfft(spectrum / np.sqrt(frequencies), count)
+    return samples / (np.abs(samples).max() or 1.0)
+
+
+def multitone(rate, duration, random, frequencies=(440, 1000)):
+    t = np.arange(int(rate * duration)) / float(rate)
+    phases = random.uniform(0, 2 * np.pi, len(frequencies))
+    samples = np.sin(2 * np.pi * np.outer(frequencies, t) + phases[:, np.newaxis]).sum(axis=0)
+    return samples / len(frequencies)
+
+
+def dtmf(rate, duration, random, digits='1234567890*#', tone=0.1, gap=0.1):
+    samples = np.zeros(int(rate * duration))
+    tone_length, step = int(rate * tone), int(rate * (tone + gap))
+    t = np.arange(tone_length) / float(rate)
+    for index, digit in enumerate(digit for digit in digits.upper() if digit in DTMF_FREQUENCIES):
+        start = index * step
+        if start + tone_length > len(samples):
+            break
+        low, high = DTMF_FREQUENCIES[digit]
+        samples[start:start+tone_length] = 0.5 * (np.sin(2 * np.pi * low * t) + np.sin(2 * np.pi * high * t))
+    return samples
+
+
+def speech(rate, duration, random, talk=1.2, pause=0.8):
+    # Pink noise gated by talk spurts and pauses of exponentially distributed
+    # length, with a ~4Hz syllabic envelope during the talk spurts.
+    count = int(rate * duration)
+    spurts = random.exponential([talk, pause], (int(duration / min(talk, pause)) + 2, 2)).ravel()
+    edges = np.minimum(np.cumsum(spurts * rate).astype(int), count)
+    gate = np.zeros(count)
+    for start, end in zip(edges[0::2], edges[1::2]):
+        gate[start:end] = 1.0
+    t = np.arange(count) / float(rate)
+    syllables = 0.6 + 0.4 * np.sin(2 * np.pi * random.uniform(3, 5) * t + random.uniform(0, 2 * np.pi))
+    return pink_noise(rate, duration, random) * gate * syllables
+
+
+GENERATORS = {'white': white_noise, 'pink': pink_noise, 'tones': multitone, 'dtmf': dtmf, 'speech': speech}
+ALIASES = {'noise': 'white', 'whitenoise': 'white', 'white-noise': 'white', 'pinknoise': 'pink', 'pink-noise': 'pink', 'tone': 'tones'}
+
+
+def generate(kind, rate, duration, seed=0, level=-20.0, **parameters):
+    """Return the signal as 16 bit signed mono samples"""
+    random = np.random.default_rng([int(hashlib.sha1(str(seed).encode()).hexdigest()[:8], 16)])
+    samples = GENERATORS[kind](rate, duration, random, **parameters)
+    return np.clip(np.round(samples * _dbfs(level) * 32767), -32768, 32767).astype('<i2')
+
+
+class SignalSpec(object):
+    """
+    A synthetic signal description as given on the command line:
+
+        kind[=parameters][:distinct]
+
+    where kind is one of white (or noise), pink, tones, dtmf or speech. The
+    parameters are the tone frequencies for tones (440+1000) and the digits
+    for dtmf (123#). With :distinct the load legs get one of variants seeded
+    signals and levels in turn instead of all of them playing the same one.
+    """
+
+    # the number of distinct signals, each of them is a file in the cache
+    variants = 32
+
+    def __init__(self, kind, parameters=None, distinct=False, duration=10.0, level=-20.0):
+        self.kind = kind
+        self.parameters = parameters or {}
+        self.distinct = distinct
+        self.duration = duration
+        self.level = level
+
+    @classmethod
+    def parse(cls, description):
+        """Return a SignalSpec or None if description does not name a synthetic signal"""
+        if not description:
+            return None
+        description, _, flag = description.partition(':')
+        if flag not in ('', 'distinct'):
+            return None
+        kind, _, value = description.partition('=')
+        kind = ALIASES.get(kind.lower(), kind.lower())
+        if kind not in GENERATORS:
+            return None
+        parameters = {}
+        if value and kind == 'tones':
+            try:
+                parameters['frequencies'] = tuple(float(frequency) for frequency in value.split('+'))
+            except ValueError:
+                return None
+        elif value and kind == 'dtmf':
+            parameters['digits'] = value
+        return cls(kind, parameters, distinct=flag == 'distinct')
+
+    def variant(self, seed):
+        """The parameters of the signal for the given seed"""
+        level = self.level
+        parameters = dict(self.parameters)
+        if self.distinct:
+            # spread the legs over a 12dB level range so that they can be told apart by level too
+            level -= int(hashlib.sha1(str(seed).encode()).hexdigest()[:4], 16) % 13
+        else:
+            seed = 0
+        return dict(kind=self.kind, seed=seed, level=level, duration=self.duration, **parameters)
+
+
+class SignalCache(object):
+    """Generated signals, stored as WAV files named after a hash of their parameters"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, spec, rate, seed=0):
+        """Return the path of the WAV file for the spec, generating it if needed"""
+        parameters = spec.variant(seed)
+        key = json.dumps(dict(parameters, rate=rate, version=VERSION), sort_keys=True)
+        path = os.path.join(self.directory, '%s-%s.wav' % (spec.kind, hashlib.sha1(key.encode()).hexdigest()[:16]))
+        if os.path.exists(path):
+            return path
+        makedirs(self.directory)
+        samples = generate(rate=rate, **parameters)
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file, wave.open(file, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(rate)
+                wav.writeframes(samples.tobytes())
+            os.rename(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return path
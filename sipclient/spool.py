@@ -0,0 +1,138 @@
+
+"""Disk backed spool for outgoing SIP MESSAGE requests"""
+
+__all__ = ['MessageSpool', 'SpooledMessage']
+
+import os
+import random
+import sqlite3
+import time
+
+from threading import Lock
+
+from application.system import makedirs
+
+
+class SpooledMessage(object):
+    def __init__(self, id, account, target, content, content_type, imdn_id, timestamp, state, attempts, next_attempt, last_error, encrypted):
+        self.id = id
+        self.account = account
+        self.target = target
+        self.content = content
+        self.content_type = content_type
+        self.imdn_id = imdn_id
+        self.timestamp = timestamp
+        self.state = state
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.last_error = last_error
+        self.encrypted = bool(encrypted)
+
+
+class MessageSpool(object):
+    """
+    Keeps outgoing messages in an SQLite database until the remote end has
+    accepted them, so that they survive restarts and can be retried with an
+    exponential backoff when the proxy or the recipient is overloaded.
+
+    A message is 'queued' until it is handed to the SIP stack, 'sending'
+    while the transaction runs and is removed once it succeeded. Messages
+    that could not be delivered after max_attempts are kept as 'failed'
+    for failed_ttl seconds.
+
+    A message is stored as it was written until it is first sent. If it
+    is PGP encrypted then, the encrypted payload replaces it, so only the
+    messages that have not been sent yet, or that are sent in clear, are
+    readable in the database. Deleted and replaced content is overwritten
+    on disk.
+    """
+
+    retry_codes = frozenset([408] + list(range(500, 600)))
+
+    def __init__(self, path, base_delay=2, max_delay=600, max_attempts=10, failed_ttl=7*86400):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.failed_ttl = failed_ttl
+        self._lock = Lock()
+        makedirs(os.path.dirname(path))
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA secure_delete=ON')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, account TEXT NOT NULL, target TEXT NOT NULL, '
+                         'content BLOB NOT NULL, content_type TEXT NOT NULL, imdn_id TEXT, timestamp TEXT, '
+                         'state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL DEFAULT 0, '
+                         'last_error TEXT, created REAL NOT NULL, encrypted INTEGER NOT NULL DEFAULT 0)')
+        if 'encrypted' not in [row[1] for row in self._db.execute('PRAGMA table_info(messages)')]:
+            self._db.execute('ALTER TABLE messages ADD COLUMN encrypted INTEGER NOT NULL DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_state ON messages (state, account)')
+        self._db.execute('DELETE FROM messages WHERE state = ? AND created < ?', ('failed', time.time() - failed_ttl))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add(self, account, target, content, content_type, imdn_id=None, timestamp=None):
+        """Store a new message and return its spool id"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO messages (account, target, content, content_type, imdn_id, timestamp, state, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (str(account), target, content, content_type, imdn_id, str(timestamp) if timestamp is not None else None, 'queued', time.time()))
+            return cursor.lastrowid
+
+    def get(self, id):
+        with self._lock:
+            row = self._db.execute('SELECT id, account, target, content, content_type, imdn_id, timestamp, state, attempts, next_attempt, last_error, encrypted FROM messages WHERE id = ?', (id,)).fetchone()
+        return SpooledMessage(*row) if row is not None else None
+
+    def pending(self, account=None):
+        """The messages (of account, if given) which were not acknowledged yet, oldest first"""
+        query = 'SELECT id, account, target, content, content_type, imdn_id, timestamp, state, attempts, next_attempt, last_error, encrypted FROM messages WHERE state IN (?, ?)'
+        arguments = ('queued', 'sending')
+        if account is not None:
+            query += ' AND account = ?'
+            arguments += (str(account),)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY id', arguments).fetchall()
+        return [SpooledMessage(*row) for row in rows]
+
+    def encrypted(self, id, content):
+        """Replace the content of a message with its encrypted payload, which is what is sent from now on"""
+        with self._lock:
+            self._db.execute('UPDATE messages SET content = ?, encrypted = 1 WHERE id = ?', (content, id))
+
+    def sending(self, id):
+        with self._lock:
+            self._db.execute('UPDATE messages SET state = ?, attempts = attempts + 1 WHERE id = ?', ('sending', id))
+
+    def delivered(self, id):
+        with self._lock:
+            self._db.execute('DELETE FROM messages WHERE id = ?', (id,))
+
+    def should_retry(self, code):
+        return code in self.retry_codes
+
+    def retry(self, id, error):
+        """
+        Schedule another attempt and return the delay in seconds, or None if
+        the message ran out of attempts and is now marked as failed.
+        """
+        message = self.get(id)
+        if message is None:
+            return None
+        if message.attempts >= self.max_attempts:
+            self.failed(id, error)
+            return None
+        # add some jitter, so that a burst of failed messages does not come back all at once
+        delay = random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * 2 ** (message.attempts - 1))
+        with self._lock:
+            self._db.execute('UPDATE messages SET state = ?, next_attempt = ?, last_error = ? WHERE id = ?', ('queued', time.time() + delay, error, id))
+        return delay
+
+    def failed(self, id, error):
+        with self._lock:
+            self._db.execute('UPDATE messages SET state = ?, last_error = ? WHERE id = ?', ('failed', error, id))
@@ -1,33 +1,127 @@
 
 """System utilities used by the sipclient scripts"""
 
-__all__ = ['IPAddressMonitor', 'copy_default_certificates']
+__all__ = ['IPAddressMonitor', 'DirectoryWatcher', 'copy_default_certificates']
 
 import os
 import shutil
+import socket
 
 from application.notification import NotificationCenter, NotificationData
 from application.system import host, makedirs
 from eventlib import api
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
 
 from sipclient.configuration import config_directory
 from sipclient.configuration.datatypes import ResourcePath
 from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import run_in_green_thread
 
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+except ImportError:
+    inotify = None
+
+
+@implementer(IReadDescriptor)
+class _NetlinkListener(object):
+    """
+    Calls callback from the twisted thread whenever the kernel reports a
+    change of the network links, addresses or routes over rtnetlink.
+    """
+
+    # multicast groups from linux/rtnetlink.h
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTMGRP_IPV6_IFADDR = 0x100
+    RTMGRP_IPV6_ROUTE = 0x400
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.socket = None
+
+    def start(self):
+        groups = self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV4_ROUTE | self.RTMGRP_IPV6_IFADDR | self.RTMGRP_IPV6_ROUTE
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        except (AttributeError, OSError):
+            return False
+        try:
+            sock.bind((0, groups))
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            return False
+        self.socket = sock
+        reactor.addReader(self)
+        return True
+
+    def stop(self):
+        if self.socket is not None:
+            reactor.removeReader(self)
+            self.socket.close()
+            self.socket = None
+
+    def fileno(self):
+        return self.socket.fileno() if self.socket is not None else -1
+
+    def doRead(self):
+        # the messages themselves are not needed, only that something changed
+        while True:
+            try:
+                if not self.socket.recv(65536):
+                    break
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS, some messages were dropped, which is a change as well
+                break
+        self.callback()
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'netlink'
+
 
 class IPAddressMonitor(object):
     """
     An object which monitors the IP address used for the default route of the
     host and posts a SystemIPAddressDidChange notification when a change is
     detected.
+
+    On Linux the kernel tells us about the changes of the addresses and routes
+    over rtnetlink and the address is checked debounce seconds after the last
+    of a burst of them, without polling. Elsewhere the address is polled every
+    5 seconds.
     """
 
+    debounce = 0.3
+
     def __init__(self):
         self.greenlet = None
+        self._netlink = None
+        self._check_timer = None
+        self._current_address = None
 
-    @run_in_green_thread
+    @run_in_twisted_thread
     def start(self):
+        if self.greenlet is not None or self._netlink is not None:
+            return
+        netlink = _NetlinkListener(self._network_changed)
+        if netlink.start():
+            self._netlink = netlink
+            self._current_address = host.default_ip
+        else:
+            self._poll()
+
+    @run_in_green_thread
+    def _poll(self):
         notification_center = NotificationCenter()
 
         if self.greenlet is not None:
@@ -46,26 +140,86 @@ class IPAddressMonitor(object):
                 current_address = new_address
             api.sleep(5)
 
+    def _network_changed(self):
+        # a change usually comes as a burst of messages, check after the last one
+        if self._check_timer is not None and self._check_timer.active():
+            self._check_timer.reset(self.debounce)
+        else:
+            self._check_timer = reactor.callLater(self.debounce, self._check_address)
+
+    def _check_address(self):
+        self._check_timer = None
+        new_address = host.default_ip
+        if new_address != self._current_address:
+            notification_center = NotificationCenter()
+            notification_center.post_notification(name='SystemIPAddressDidChange', sender=self, data=NotificationData(old_ip_address=self._current_address, new_ip_address=new_address))
+            self._current_address = new_address
+
     @run_in_twisted_thread
     def stop(self):
+        if self._check_timer is not None and self._check_timer.active():
+            self._check_timer.cancel()
+        self._check_timer = None
+        if self._netlink is not None:
+            self._netlink.stop()
+            self._netlink = None
         if self.greenlet is not None:
             api.kill(self.greenlet, api.GreenletExit())
             self.greenlet = None
 
 
-def copy_default_certificates():
+class DirectoryWatcher(object):
+    """
+    Calls callback from the twisted thread with the path of every file that
+    is written and closed in, or moved into, a directory. It uses inotify,
+    so it costs nothing while nothing happens. start() returns False where
+    inotify is not available, in which case the directory must be polled.
+    """
+
+    def __init__(self, directory, callback):
+        self.directory = directory
+        self.callback = callback
+        self._notifier = None
+
+    def start(self):
+        if inotify is None:
+            return False
+        try:
+            notifier = inotify.INotify()
+        except (inotify.INotifyError, OSError):
+            return False
+        try:
+            notifier.startReading()
+            notifier.watch(FilePath(self.directory), mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO, callbacks=[self._changed])
+        except (inotify.INotifyError, OSError):
+            notifier.loseConnection()
+            return False
+        self._notifier = notifier
+        return True
+
+    def stop(self):
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def _changed(self, watch, filepath, mask):
+        # the inotify paths are bytes, the callback gets the same str as the directory
+        self.callback(os.fsdecode(filepath.path))
+
+
+def copy_default_certificates(directory=config_directory):
     default_tls_certificate = ResourcePath('tls/default.crt').normalized
-    local_tls_certificate = os.path.join(config_directory, 'tls/default.crt')
+    local_tls_certificate = os.path.join(directory, 'tls/default.crt')
 
     if not os.path.isfile(local_tls_certificate):
-        makedirs(os.path.join(config_directory, 'tls'))
+        makedirs(os.path.join(directory, 'tls'))
         shutil.copy(default_tls_certificate, local_tls_certificate)
 
     default_tls_ca = ResourcePath('tls/ca.crt').normalized
-    local_tls_ca = os.path.join(config_directory, 'tls/ca.crt')
+    local_tls_ca = os.path.join(directory, 'tls/ca.crt')
 
     if not os.path.isfile(local_tls_ca):
-        makedirs(os.path.join(config_directory, 'tls'))
+        makedirs(os.path.join(directory, 'tls'))
         shutil.copy(default_tls_ca, local_tls_ca)
 
         
\ No newline at end of file
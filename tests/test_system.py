@@ -0,0 +1,45 @@
+
+"""Tests for sipclient.system"""
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from sipclient.system import DirectoryWatcher
+
+
+class DirectoryWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.paths = []
+        self.ready = defer.Deferred()
+        self.watcher = DirectoryWatcher(self.directory, self._changed)
+        if not self.watcher.start():
+            raise unittest.SkipTest('inotify is not available')
+        self.addCleanup(self.watcher.stop)
+
+    def _changed(self, path):
+        # the callback runs the same code as the playback spool consumers
+        if path.endswith('.wav'):
+            self.paths.append(path)
+            if len(self.paths) == 2:
+                self.ready.callback(None)
+
+    def _write(self, name):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(b'RIFF')
+
+    @defer.inlineCallbacks
+    def test_wav_files_are_reported_as_str(self):
+        self._write('alice@example.com.wav')
+        # a second file makes sure the watcher survives the first callback
+        reactor.callLater(0.1, self._write, 'bob@example.com.wav')
+        yield self.ready
+        self.assertEqual(self.paths, [os.path.join(self.directory, 'alice@example.com.wav'), os.path.join(self.directory, 'bob@example.com.wav')])
+        self.assertTrue(all(isinstance(path, str) for path in self.paths))
+
+    test_wav_files_are_reported_as_str.timeout = 5
@@ -3,18 +3,27 @@
 import pyaudio
 import wave
 from ctypes import *
+from ctypes.util import find_library
 from optparse import OptionParser
 from pathlib import Path
 import math
+import numpy as np
 import platform
 import psutil
-import struct
+import select
+import tempfile
+import socket
+import threading
 import wave
 import time
+from collections import deque
 import os
 import sys
 from datetime import datetime
+import copy
 import functools
+import json
+import uuid
 print = functools.partial(print, flush=True)
 
 # remove useless alsa logging
@@ -52,43 +61,338 @@ def checkIfProcessRunning(processName):
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             pass
     return False;
-    
+
+
+class ProcessMonitor:
+    '''
+    Keeps checking in a thread whether a process with the given name runs,
+    walking the process table every interval seconds instead of on demand.
+    '''
+
+    def __init__(self, name, interval=2):
+        self.name = name
+        self.interval = interval
+        self.running = checkIfProcessRunning(name)
+        thread = threading.Thread(target=self._run, name='Process monitor', daemon=True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.running = checkIfProcessRunning(self.name)
+
+
+class ControlFiles:
+    '''
+    Tracks whether the lock, trigger and enable files exist, so the audio
+    loop only looks at a dict. A thread waits for inotify events on their
+    directories and checks the files again when any of them changes. The
+    files are polled every interval seconds where inotify is not available
+    or their directory does not exist.
+    '''
+
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, paths, interval=0.25):
+        self.paths = [path for path in paths if path]
+        self.interval = interval
+        self.state = {}
+        self.refresh()
+        self.fd = None
+        self.polled = False
+        self._watch()
+        thread = threading.Thread(target=self._run, name='Control files', daemon=True)
+        thread.start()
+
+    def exists(self, path):
+        return self.state.get(path, False)
+
+    def refresh(self):
+        self.state = {path: os.path.exists(path) for path in self.paths}
+
+    def _watch(self):
+        directories = {os.path.dirname(os.path.abspath(path)) for path in self.paths}
+        try:
+            libc = CDLL(find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            fd = -1
+        if fd < 0:
+            self.polled = bool(self.paths)
+            return
+        mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_ATTRIB | self.IN_MODIFY
+        for directory in directories:
+            if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                self.polled = True
+        self.fd = fd
+
+    def _run(self):
+        while True:
+            if self.fd is not None:
+                # without polling a periodic check still catches missed events
+                ready, _, _ = select.select([self.fd], [], [], self.interval if self.polled else 5)
+                if ready:
+                    os.read(self.fd, 65536)
+            else:
+                time.sleep(self.interval)
+            self.refresh()
+
 
 f_name_directory = '%s/.sipclient/spool/playback' % Path.home()
 lock_file = '%s/.sipclient/spool/playback/playback.lock' % Path.home()
+live_socket = '%s/.sipclient/spool/live.sock' % Path.home()
 
 
-class Recorder:
-    chunk = 1024
-    channels = 1
-    stream = None
-    recording_stream = None
-
-    @staticmethod
-    def rms(frame):
-        SHORT_NORMALIZE = (1.0/32768.0)
-        count = len(frame) / 2
-        format = "%dh" % (count)
-        shorts = struct.unpack(format, frame)
-
-        sum_squares = 0.0
-        for sample in shorts:
-            n = sample * SHORT_NORMALIZE
-            sum_squares += n * n
-        rms = math.pow(sum_squares / count, 0.5)
-
-        return rms * 1000
-
-    def __init__(self, target, options):
-        self.p = pyaudio.PyAudio()
-        info = self.p.get_host_api_info_by_index(0)
-        numdevices = info.get('deviceCount')
+class LevelMeter:
+    '''
+    Level of the 16 bit audio chunks of all channels of a stream at once,
+    on the same 0-1000 scale as the threshold: the RMS and the peak of each
+    channel and an envelope that follows the RMS quickly when it rises and
+    slowly when it falls. The samples are interleaved like PyAudio returns
+    them and every value is returned as an array with one item per channel.
+    '''
+
+    def __init__(self, channels=1, attack=0.5, release=0.05):
+        self.channels = channels
+        self.attack = attack
+        self.release = release
+        self.envelope = np.zeros(channels)
+
+    def measure(self, frame):
+        samples = np.frombuffer(frame, dtype='<i2').reshape(-1, self.channels).astype(np.float32)
+        if not len(samples):
+            return np.zeros(self.channels), np.zeros(self.channels), self.envelope
+        rms = np.sqrt(np.einsum('ij,ij->j', samples, samples) / len(samples)) * 1000 / 32768
+        peak = np.abs(samples).max(axis=0) * 1000 / 32768
+        self.envelope += np.where(rms > self.envelope, self.attack, self.release) * (rms - self.envelope)
+        return rms, peak, self.envelope
+
+
+class WaveWriter:
+    '''
+    Streams a recording to a temporary wav file in the playback directory,
+    the header is patched when the file is closed and then it is renamed to
+    user@domain.wav, so sip-session3 only ever sees complete files. With
+    segment_time the recording is published in parts of that many seconds
+    while it goes on. The parts after the first are named user@domain+N.wav,
+    sip-session3 and sip-audio-session3 ignore the +N when they call the
+    target. A name given in place of the target is used for the files. No
+    part is published until release() is called, once the recording is
+    long enough to be kept, the first part holds what was recorded until
+    then.
+    '''
+
+    def __init__(self, directory, target, rate, channels=1, sample_width=2, segment_time=None, name=None):
+        self.directory = directory
+        self.target = target
+        self.name = name or target
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.segment_time = segment_time
+        self.tmp_filename = os.path.join(directory, '%s.tmp' % self.name)
+        self.segments = 0
+        self.frames = 0
+        self.segment_frames = 0
+        self.held = True
+        self.wf = None
+        self._open()
+
+    @property
+    def duration(self):
+        return self.frames / self.rate
+
+    def write(self, data):
+        '''Add data to the recording and return the name of the segment it completed, if any'''
+        self.wf.writeframesraw(data)
+        frames = len(data) // (self.channels * self.sample_width)
+        self.frames += frames
+        self.segment_frames += frames
+        return self._segment()
+
+    def release(self):
+        '''Let the segments be published, return the name of a segment that is already complete'''
+        self.held = False
+        return self._segment()
+
+    def close(self):
+        '''Publish the rest of the recording and return the name of its file'''
+        if self.segments and not self.segment_frames:
+            self.discard()
+            return None
+        return self._publish()
+
+    def discard(self):
+        self.wf.close()
+        try:
+            os.remove(self.tmp_filename)
+        except OSError:
+            pass
+
+    def _segment(self):
+        if not self.held and self.segment_time and self.segment_frames >= self.segment_time * self.rate:
+            filename = self._publish()
+            self._open()
+            return filename
+        return None
+
+    def _open(self):
+        self.wf = wave.open(self.tmp_filename, 'wb')
+        self.wf.setnchannels(self.channels)
+        self.wf.setsampwidth(self.sample_width)
+        self.wf.setframerate(self.rate)
+        self.segment_frames = 0
+
+    def _publish(self):
+        self.wf.close()
+        self.segments += 1
+        if self.segments == 1:
+            filename = os.path.join(self.directory, '%s.wav' % self.name)
+        else:
+            filename = os.path.join(self.directory, '%s+%d.wav' % (self.name, self.segments))
+        os.replace(self.tmp_filename, filename)
+        return filename
+
+
+class LiveWriter:
+    '''
+    Sends a recording while it is made to a sip-session3 started with
+    --live-relay, which plays it right away into a call to the target.
+    It takes the place of a WaveWriter and nothing is saved. The audio is
+    held back until start() is called, once the recording is long enough
+    to be kept, so noises never make a call. A recording discarded after
+    that is cancelled and the relay drops what it has not played yet.
+    '''
+
+    def __init__(self, path, target, rate):
+        self.path = path
+        self.target = target
+        self.rate = rate
+        self.id = uuid.uuid4().hex
+        self.socket = None
+        self.buffer = []
+        # like a published segment, once started the lock file is our own call
+        self.segments = 0
+
+    @property
+    def held(self):
+        return not self.segments
+
+    def start(self):
+        '''Connect to the relay and send the audio so far, return False if no relay listens there'''
+        sock = self._connect({'target': self.target, 'rate': self.rate, 'id': self.id})
+        if sock is None:
+            return False
+        try:
+            sock.sendall(b''.join(self.buffer))
+        except OSError:
+            sock.close()
+            return False
+        self.socket = sock
+        self.buffer = []
+        self.segments = 1
+        return True
+
+    def write(self, data):
+        if not self.segments:
+            self.buffer.append(data)
+        elif self.socket is not None:
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                self.close()
+        return None
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        return None
+
+    def discard(self):
+        self.buffer = []
+        if self.segments:
+            self.close()
+            sock = self._connect({'id': self.id, 'cancel': True})
+            if sock is not None:
+                sock.close()
+
+    def _connect(self, header):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(0.5)
+        try:
+            sock.connect(self.path)
+            sock.sendall((json.dumps(header) + '\n').encode())
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+
+class FileStream:
+    '''
+    Reads a 16 bit wav file in place of a PyAudio input stream, in real
+    time or speed times faster, or as fast as possible with speed 0. The
+    read after the end of the file raises EOFError.
+    '''
+
+    def __init__(self, path, speed=0):
+        self.wf = wave.open(path, 'rb')
+        if self.wf.getsampwidth() != 2:
+            raise ValueError('%s is not a 16 bit wav file' % path)
+        self.channels = self.wf.getnchannels()
+        self.rate = self.wf.getframerate()
+        self.speed = speed
+        self.frames = 0
+        self.started = None
+
+    @property
+    def position(self):
+        return self.frames / self.rate
+
+    def read(self, count, exception_on_overflow=True):
+        data = self.wf.readframes(count)
+        if not data:
+            raise EOFError
+        data = data.ljust(count * 2 * self.channels, b'\0')
+        self.frames += count
+        if self.speed:
+            if self.started is None:
+                self.started = time.monotonic()
+            delay = self.started + self.position / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def close(self):
+        self.wf.close()
+
+
+class Channel:
+    '''
+    One target recorded from one input channel of a capture device, with
+    its own threshold, timeouts and listen -> record -> hangover state.
+    '''
+
+    LISTEN, RECORD, HANGOVER = 'listen', 'record', 'hangover'
+
+    def __init__(self, recorder, target, options):
+        self.recorder = recorder
+        self.control = recorder.control
         self.locks = set()
 
         self.target = target
+        self.label = None
+        self.device = options.device
+        self.input = options.input
         self.timeout_length = options.timeout
         self.rate = options.rate
-        self.device = options.device
         self.min_rec_time = options.min_rec_time
         self.max_rec_time = options.max_rec_time
         self.external_lock_file = options.external_lock_file
@@ -96,159 +400,125 @@ class Recorder:
         self.level_lock_file = options.level_lock_file
         self.level_enable_file = options.level_enable_file
         self.quiet = options.quiet
+        self.segment_time = options.segment_time
+        self.live_relay = options.live_relay
 
         self.started_by_file = False
         self.started_by_level = False
 
-        print("Recording to %s" % (os.path.join(f_name_directory, '%s.wav' % self.target)))
+        self.state = self.LISTEN
+        self.writer = None
+        self.rec_time = 0
+        self.start_time = None
+        self.end_time = None
+        self.preroll = deque(maxlen=int(math.ceil(options.pre_roll * self.rate / recorder.chunk)))
 
-        devices = {}
-        devices_text = []
-        for i in range(0, numdevices):
-            if (self.p.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
-                devices[i] = self.p.get_device_info_by_host_api_device_index(0, i).get('name')
-                if devices[i] == str(self.device):
-                    self.device = i
-                elif str(i) == str(self.device):
-                    self.device = i
-
-                devices_text.append("%s) %s" % (i, devices[i]))
-
-        print('Available devices: %s' % ", ".join(devices_text))
-        try:
-            print('Using audio device %s) %s at sample rate %d' % (self.device, devices[self.device], self.rate))
-        except KeyError:
-            print('Non existent audio device')
+        print("Recording to %s" % (os.path.join(recorder.directory, '%s.wav' % self.target)))
 
         self.threshold = 0 if target == 'test' else options.threshold
 
-    def start_recording_stream(self):
-        if self.recording_stream:
-            self.stop_recording_stream()
-        
-        self.stream.stop_stream()
-        self.stream.close()
-        self.stream = None
-            
-        self.recording_stream = self.p.open(format=pyaudio.paInt16,
-                                  channels=self.channels,
-                                  rate=self.rate,
-                                  input=True,
-                                  output=True,
-                                  input_device_index=self.device,
-                                  frames_per_buffer=self.chunk)
-
-    def stop_recording_stream(self):
-        self.recording_stream.stop_stream()
-        self.recording_stream.close()
-        self.recording_stream = None
-
-    def listen(self):
-        i = 0
+    def timestamp(self):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return '%s [%s]' % (now, self.label) if self.label else now
+
+    def process(self, data, rms_val, peak_val, envelope, now):
+        if self.label:
+            now = '%s [%s]' % (now, self.label)
+        if self.state == self.LISTEN:
+            self.listen_chunk(data, rms_val, peak_val, envelope, now)
+        else:
+            self.record_chunk(data, rms_val, now)
+
+    def listen_chunk(self, input, rms_val, peak_val, envelope, now):
+        if self.control.exists(lock_file):
+            if lock_file not in self.locks:
+                print("%s - lock file %s present, listen paused" % (now, lock_file))
+            self.locks.add(lock_file)
+            self.preroll.clear()
+            return
+        else:
+            if lock_file in self.locks:
+                #print("%s - lock file %s absent" % (now, lock_file))
+                self.remove_lock(lock_file)
+
+                if len(self.locks) == 0:
+                    print("%s - listen resumed" % now)
+
+        if self.external_lock_file:
+            if self.control.exists(self.external_lock_file):
+                if self.external_lock_file not in self.locks:
+                    print("%s - external lock file %s present, listen paused" % (now, self.external_lock_file))
+                self.locks.add(self.external_lock_file)
+                self.preroll.clear()
+                return
+            else:
+                if self.external_lock_file in self.locks:
+                    print("%s - external lock file %s absent" % (now, self.external_lock_file))
 
-        while True:
-            i = i + 1 
-            if self.stream is None:
-                try:
-                    self.stream = self.p.open(format=pyaudio.paInt16,
-                                  channels=self.channels,
-                                  rate=self.rate,
-                                  input=True,
-                                  output=True,
-                                  input_device_index=self.device,
-                                  frames_per_buffer=self.chunk)
-                except ValueError as e:
-                    print("Invalid audio device %s" % self.device)
-                    break
+                    self.remove_lock(self.external_lock_file)
+                    if len(self.locks) == 0:
+                        print("%s - listen resumed" % now)
 
-            input = self.stream.read(self.chunk, exception_on_overflow = False)
-            rms_val = self.rms(input)
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if self.level_lock_file:
+            if self.control.exists(self.level_lock_file):
+                if self.level_lock_file not in self.locks:
+                    print("%s - level lock file %s present, listen paused" % (now, self.level_lock_file))
 
-            if os.path.exists(lock_file):
-                if lock_file not in self.locks:
-                    print("%s - lock file %s present, listen paused" % (now, lock_file))
-                self.locks.add(lock_file)
-                continue
+                self.locks.add(self.level_lock_file)
+                self.preroll.clear()
+                return
             else:
-                if lock_file in self.locks:
-                    #print("%s - lock file %s absent" % (now, lock_file))
-                    self.remove_lock(lock_file)
+                if self.level_lock_file in self.locks:
+                    print("%s - level lock file %s absent" % (now, self.level_lock_file))
+                    self.remove_lock(self.level_lock_file)
 
                     if len(self.locks) == 0:
                         print("%s - listen resumed" % now)
 
-            if self.external_lock_file:
-                if os.path.exists(self.external_lock_file):
-                    if self.external_lock_file not in self.locks:
-                        print("%s - external lock file %s present, listen paused" % (now, self.external_lock_file))
-                    self.locks.add(self.external_lock_file)
-                    continue
+        self.preroll.append(input)
+
+        if self.external_trigger_file:
+            if self.control.exists(self.external_trigger_file):
+                if not self.started_by_file:
+                    print('%s - recording by file %s' % (now, self.external_trigger_file))
+                self.started_by_file = True
+
+        if self.threshold and not self.started_by_file:
+            if self.level_enable_file:
+                if not self.control.exists(self.level_enable_file):
+                    if self.level_enable_file not in self.locks:
+                        print("%s - level enable file %s missing, listen paused" % (now, self.level_enable_file))
+                    self.locks.add(self.level_enable_file)
+                    if sys.stdout.isatty():
+                        print("%s - not listening, level %4d" % (now, rms_val), end='\r')
+                    return
                 else:
-                    if self.external_lock_file in self.locks:
-                        print("%s - external lock file %s absent" % (now, self.external_lock_file))
-
-                        self.remove_lock(self.external_lock_file)
+                    if self.level_enable_file in self.locks:
+                        print("%s - level enable file %s present" % (now, self.level_enable_file))
+                        self.remove_lock(self.level_enable_file)
                         if len(self.locks) == 0:
                             print("%s - listen resumed" % now)
 
-            if self.level_lock_file:
-                if os.path.exists(self.level_lock_file):
-                    if self.level_lock_file not in self.locks:
-                        print("%s - level lock file %s present, listen paused" % (now, self.level_lock_file))
-
-                    self.locks.add(self.level_lock_file)
-                    continue
+            if rms_val >= self.threshold:
+                if not self.started_by_level:
+                    print('%s - recording by level %3d > %d' % (now, rms_val, self.threshold))
+                self.started_by_level = True
+
+        if self.started_by_level:
+            self.record('level')
+        elif self.started_by_file:
+            self.record('file')
+        else:
+            if not self.quiet:
+                if self.external_trigger_file:
+                    if sys.stdout.isatty():
+                        print("%s - listening, level %4d" % (now, rms_val), end='\r')
                 else:
-                    if self.level_lock_file in self.locks:
-                        print("%s - level lock file %s absent" % (now, self.level_lock_file))
-                        self.remove_lock(self.level_lock_file)
-
-                        if len(self.locks) == 0:
-                            print("%s - listen resumed" % now)
-
-            if self.external_trigger_file:
-                if os.path.exists(self.external_trigger_file):
-                    if not self.started_by_file:
-                        print('%s - recording by file %s' % (now, self.external_trigger_file))
-                    self.started_by_file = True
-            
-            if self.threshold and not self.started_by_file:
-                if self.level_enable_file:
-                    if not os.path.exists(self.level_enable_file):
-                        if self.level_enable_file not in self.locks:
-                            print("%s - level enable file %s missing, listen paused" % (now, self.level_enable_file))
-                        self.locks.add(self.level_enable_file)
-                        if sys.stdout.isatty():
-                            print("%s - not listening, level %4d" % (now, rms_val), end='\r')
-                        continue
-                    else:
-                        if self.level_enable_file in self.locks:
-                            print("%s - level enable file %s present" % (now, self.level_enable_file))
-                            self.remove_lock(self.level_enable_file)
-                            if len(self.locks) == 0:
-                                print("%s - listen resumed" % now)
-                
-                if rms_val >= self.threshold:
-                    if not self.started_by_level:
-                        print('%s - recording by level %3d > %d' % (now, rms_val, self.threshold))
-                    self.started_by_level = True
-            
-            if self.started_by_level:
-                self.record('level')
-            elif self.started_by_file:
-                self.record('file')
-            else:
-                if not self.quiet:
-                    if self.external_trigger_file:
-                        if sys.stdout.isatty():
-                            print("%s - listening, level %4d" % (now, rms_val), end='\r')
-                    else:
-                        if sys.stdout.isatty():
-                            if self.target == 'test':
-                                print("%s - listening, level %4d" % (now, rms_val), end='\r')
-                            else:
-                                print("%s - listening, level %4d < %4d" % (now, rms_val, self.threshold), end='\r')
+                    if sys.stdout.isatty():
+                        if self.target == 'test':
+                            print("%s - listening, level %4d, peak %4d, envelope %4d" % (now, rms_val, peak_val, envelope), end='\r')
+                        else:
+                            print("%s - listening, level %4d < %4d" % (now, rms_val, self.threshold), end='\r')
 
     def remove_lock(self, lock):
         try:
@@ -257,86 +527,310 @@ class Recorder:
             pass
 
     def record(self, source=None):
-        rec = []
-        current = time.time()
-        end = time.time() + self.timeout_length
-        start_time = current
-        fst = 'festival'
-        if checkIfProcessRunning(fst):
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if self.recorder.festival is not None and self.recorder.festival.running:
             self.started_by_file = False
             self.started_by_level = False
             return
 
-        recording = False
-        i = 0
-        rec_time = 0 
+        # the chunks before the trigger, including the one that crossed the
+        # threshold, start the recording
+        self.start_time = self.recorder.clock()
+        if self.live_relay:
+            self.writer = LiveWriter(live_socket, self.target, self.rate)
+        else:
+            self.writer = self.wave_writer()
+        for data in self.preroll:
+            self.writer.write(data)
+        self.preroll.clear()
+        self.end_time = self.start_time + self.timeout_length
+        self.rec_time = 0
+        self.state = self.RECORD
+        self.recorder.event(self, 'start by %s' % source)
+
+        print('%s - now recording by %s...' % (self.timestamp(), source))
+
+    def record_chunk(self, data, rms_val, now):
+        if self.started_by_level:
+            if rms_val >= self.threshold:
+                self.end_time = self.recorder.clock() + self.timeout_length
+                self.state = self.RECORD
+            else:
+                self.state = self.HANGOVER
+            diff = self.recorder.clock() - self.start_time
+            if not self.quiet and sys.stdout.isatty():
+                print('%s - recording at level %3d for %.1f seconds' % (now, rms_val, diff), end='\r')
+            self.write_chunk(data, now)
+
+            self.rec_time = self.recorder.clock() - self.start_time
+            if self.rec_time > self.max_rec_time:
+                #print("%s - maximum recording time of %d seconds reached" % (now, self.rec_time))
+                self.stop_recording(now)
+                return
+            self.rec_time = self.recorder.clock() - self.start_time - self.timeout_length
 
-        self.start_recording_stream()
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print('%s - now recording by %s...' % (now, source))
+            if self.control.exists(lock_file) and not self.writer.segments:
+                print("%s - lock file %s detected" % (now, lock_file))
+                self.stop_recording(now)
+            elif self.recorder.clock() > self.end_time:
+                self.stop_recording(now)
 
-        if self.started_by_level:        
-            while current <= end:
-                i = i + 1 
-                data = self.recording_stream.read(self.chunk)
-                rms_val = self.rms(data)
-                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        elif self.started_by_file:
+            if not self.control.exists(self.external_trigger_file):
+                self.stop_recording(now)
+                return
+            if not self.quiet and sys.stdout.isatty():
+                    print('%s - recording by file at level %3d' % (now, rms_val), end='\r')
+            self.write_chunk(data, now)
+
+            self.rec_time = self.recorder.clock() - self.start_time
+            if self.max_rec_time and self.rec_time > self.max_rec_time:
+                self.stop_recording(now)
+            elif self.control.exists(lock_file) and not self.writer.segments:
+                print("%s - lock file %s detected" % (now, lock_file))
+                self.stop_recording(now)
+
+    def write_chunk(self, data, now):
+        filename = self.writer.write(data)
+        if self.writer.held and self.long_enough() and self.lock_reason(self.writer) is None:
+            if isinstance(self.writer, LiveWriter):
+                self.writer = self.start_live(self.writer, now)
+            else:
+                filename = self.writer.release()
+        if filename is not None:
+            # the call to play this part holds the lock file while we go on recording
+            print('%s - saved segment to %s' % (now, filename))
+
+    def long_enough(self):
+        '''Whether the recording so far will not be skipped as too short'''
+        if self.started_by_level:
+            # the hangover after the last chunk above the threshold does not count
+            return self.end_time - self.timeout_length - self.start_time >= self.min_rec_time
+        return True
+
+    def start_live(self, writer, now):
+        '''Start relaying the recording live, or go on with it in a file if that fails'''
+        if writer.start():
+            print('%s - relaying live to %s' % (now, live_socket))
+            self.recorder.event(self, 'relay live')
+            return writer
+        print('%s - live relay %s not available, recording to file' % (now, live_socket))
+        wave_writer = self.wave_writer()
+        for data in writer.buffer:
+            wave_writer.write(data)
+        filename = wave_writer.release()
+        if filename is not None:
+            print('%s - saved segment to %s' % (now, filename))
+        return wave_writer
+
+    def stop_recording(self, now):
+        writer, self.writer = self.writer, None
+        self.state = self.LISTEN
+
+        if self.started_by_level:
+            self.started_by_level = False
+            if self.rec_time >= self.min_rec_time:
+                self.write(writer, self.rec_time)
+            else:
+                print("%s - skip too short recording of %.1f seconds" % (now, self.rec_time))
+                self.recorder.event(self, 'skip too short recording of %.1f seconds' % self.rec_time)
+                writer.discard()
+            return
 
-                if rms_val >= self.threshold: end = time.time() + self.timeout_length
-                    #if not recording:
-                diff = time.time() - start_time
-                if not self.quiet and sys.stdout.isatty():
-                    print('%s - recording at level %3d for %.1f seconds' % (now, rms_val, diff), end='\r')
-                recording = True
+        self.started_by_file = False
+        if self.rec_time:
+            print("%s - recorded %.1f seconds" % (now, self.rec_time))
+            self.write(writer, self.rec_time)
+        else:
+            self.recorder.event(self, 'skip empty recording')
+            writer.discard()
+
+    def wave_writer(self):
+        name = None
+        if self.recorder.replay is not None:
+            # all the recordings of a replay are kept, named by where they start in the file
+            name = '%s-%09.2f' % (self.target, self.start_time)
+        return WaveWriter(self.recorder.directory, self.target, self.rate, 1, self.recorder.sample_size, self.segment_time, name)
+
+    def lock_reason(self, writer):
+        '''Return why a lock file keeps the recording from being saved, if one does'''
+        if self.control.exists(lock_file) and not writer.segments:
+            return 'lock file %s present' % lock_file
+        if self.external_lock_file and self.control.exists(self.external_lock_file):
+            return 'external lock file %s present' % self.external_lock_file
+        if self.level_lock_file and self.control.exists(self.level_lock_file):
+            return 'level lock file %s present' % self.level_lock_file
+        return None
+
+    def write(self, writer, duration):
+        now = self.timestamp()
+        reason = self.lock_reason(writer)
+        if reason is not None:
+            print("%s - %s, skip file" % (now, reason))
+            self.recorder.event(self, 'skip recording, %s' % reason)
+            writer.discard()
+            return
 
-                current = time.time()
-                rec.append(data)
+        if isinstance(writer, LiveWriter) and not writer.segments:
+            writer = self.start_live(writer, now)
+        filename = writer.close()
+        if filename is None:
+            self.recorder.event(self, 'end after %.1f seconds' % duration)
+            return
+        self.recorder.event(self, 'saved %.1f seconds of audio to %s' % (writer.duration, os.path.basename(filename)))
+        print('%s - saved %d seconds audio to %s' % (now, duration, filename))
 
-                rec_time = time.time() - start_time
-                if rec_time > self.max_rec_time:
-                    #print("%s - maximum recording time of %d seconds reached" % (now, rec_time))
-                    break
-                else: 
-                    rec_time = time.time() - start_time - self.timeout_length
-                
-                if os.path.exists(lock_file):
-                    print("%s - lock file %s detected" % (now, lock_file))
+        if self.target == 'test':
+            self.recorder.play(filename)
+
+
+class Input:
+    '''A capture stream and the channels recorded from it'''
+
+    def __init__(self, device, channels):
+        self.device = device
+        self.channels = channels
+        self.count = max(channel.input for channel in channels) + 1
+        self.meter = LevelMeter(self.count)
+        self.stream = None
+
+
+class Recorder:
+    chunk = 1024
+
+    def __init__(self, targets, options, replay=None):
+        self.rate = options.rate
+        self.replay = replay
+        self.events = None
+        self.timings = None
+        self.clock = time.time
+        self.directory = f_name_directory
+
+        if replay is not None:
+            # a replay is not affected by the state of this machine and
+            # its recordings do not go to the playback spool
+            self.p = None
+            self.sample_size = 2
+            self.directory = options.replay_output or tempfile.mkdtemp(prefix='va-recorder-')
+            self.control = ControlFiles([options.external_lock_file, options.external_trigger_file, options.level_lock_file, options.level_enable_file])
+            self.festival = None
+            self.events = []
+            self.timings = []
+            self.clock = lambda: replay.position
+        else:
+            self.p = pyaudio.PyAudio()
+            self.sample_size = self.p.get_sample_size(pyaudio.paInt16)
+            self.control = ControlFiles([lock_file, options.external_lock_file, options.external_trigger_file, options.level_lock_file, options.level_enable_file])
+            self.festival = ProcessMonitor('festival')
+
+        self.channels = [Channel(self, target, channel_options) for target, channel_options in targets]
+        if len(self.channels) > 1:
+            for channel in self.channels:
+                # the status lines of several channels would overwrite each other
+                channel.label = channel.target
+                channel.quiet = True
+
+        if replay is not None:
+            input = Input(options.replay, self.channels)
+            input.count = replay.channels
+            input.meter = LevelMeter(input.count)
+            input.stream = replay
+            self.inputs = [input]
+            print('Replaying %s at %s' % (options.replay, 'full speed' if not replay.speed else '%gx real time' % replay.speed))
+            return
+
+        info = self.p.get_host_api_info_by_index(0)
+        numdevices = info.get('deviceCount')
+
+        devices = {}
+        devices_text = []
+        for i in range(0, numdevices):
+            if (self.p.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
+                devices[i] = self.p.get_device_info_by_host_api_device_index(0, i).get('name')
+                devices_text.append("%s) %s" % (i, devices[i]))
+
+        print('Available devices: %s' % ", ".join(devices_text))
+
+        # the channels of one device share its stream
+        inputs = {}
+        for channel in self.channels:
+            device = channel.device
+            for i, name in devices.items():
+                if name == str(device) or str(i) == str(device):
+                    device = i
                     break
+            inputs.setdefault(device, []).append(channel)
+        self.inputs = [Input(device, channels) for device, channels in inputs.items()]
 
-            if rec_time >= self.min_rec_time:
-                self.write(b''.join(rec), rec_time)
-            else:
-                print("%s - skip too short recording of %.1f seconds" % (now, rec_time))
-                self.started_by_level = False
-                return
+        for input in self.inputs:
+            try:
+                print('Using audio device %s) %s at sample rate %d for %s' % (input.device, devices[input.device], self.rate, ", ".join(channel.target for channel in input.channels)))
+            except KeyError:
+                print('Non existent audio device')
+
+    def open_stream(self, input):
+        try:
+            input.stream = self.p.open(format=pyaudio.paInt16,
+                          channels=input.count,
+                          rate=self.rate,
+                          input=True,
+                          input_device_index=input.device,
+                          frames_per_buffer=self.chunk)
+        except ValueError as e:
+            print("Invalid audio device %s" % input.device)
+            return False
+        return True
 
-        if self.started_by_file:
-            while os.path.exists(self.external_trigger_file):
-                i = i + 1 
-                data = self.recording_stream.read(self.chunk)
-                rms_val = self.rms(data)
+    def listen(self):
+        # The input streams stay open all the time, the same chunks feed the
+        # pre-roll buffers while listening and the recordings once triggered.
+        while True:
+            for input in self.inputs:
+                if input.stream is None and not self.open_stream(input):
+                    return
+
+                try:
+                    frame = input.stream.read(self.chunk, exception_on_overflow = False)
+                except EOFError:
+                    self.finish()
+                    return
+                started = time.perf_counter()
+                rms_val, peak_val, envelope = input.meter.measure(frame)
                 now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                if not self.quiet and sys.stdout.isatty():
-                        print('%s - recording by file at level %3d' % (now, rms_val), end='\r')
-                recording = True
-                current = time.time()
-                rec.append(data)
-
-                rec_time = time.time() - start_time
-                if self.max_rec_time and rec_time > self.max_rec_time:
-                    break
 
-                if os.path.exists(lock_file):
-                    print("%s - lock file %s detected" % (now, lock_file))
-                    break
-            
-        if rec_time:
-            print("%s - recorded %.1f seconds" % (now, rec_time))
-            self.write(b''.join(rec), rec_time)
+                if input.count == 1:
+                    input.channels[0].process(frame, rms_val[0], peak_val[0], envelope[0], now)
+                else:
+                    samples = np.frombuffer(frame, dtype='<i2').reshape(-1, input.count)
+                    for channel in input.channels:
+                        i = channel.input
+                        channel.process(samples[:, i].tobytes(), rms_val[i], peak_val[i], envelope[i], now)
+
+                if self.timings is not None:
+                    self.timings.append(time.perf_counter() - started)
+
+    def event(self, channel, description):
+        if self.events is not None:
+            self.events.append((self.clock(), channel.target, description))
+
+    def finish(self):
+        '''End the recordings in progress when a replay reaches the end of its file and report on it'''
+        for channel in self.channels:
+            if channel.state != channel.LISTEN:
+                # the file ended before the silence timeout, keep all of the recording
+                channel.rec_time = self.clock() - channel.start_time
+                channel.stop_recording(channel.timestamp())
+        if self.replay is None:
+            return
 
-        self.started_by_file = False
-        self.started_by_level = False
+        print()
+        print('Replay of %.1f seconds of audio, recordings saved in %s' % (self.replay.position, self.directory))
+        for position, target, description in self.events:
+            print('  %8.2fs %s: %s' % (position, target, description))
+        if self.timings:
+            timings = np.array(self.timings) * 1e6
+            chunk_time = self.chunk / self.rate * 1e6
+            print('Processing time per chunk of %d frames: average %.1fus, median %.1fus, 99th percentile %.1fus, maximum %.1fus (%.2f%% of real time)' % (
+                  self.chunk, timings.mean(), np.percentile(timings, 50), np.percentile(timings, 99), timings.max(), timings.mean() * 100 / chunk_time))
 
     def play(self, file):
         p = pyaudio.PyAudio()
@@ -357,46 +851,16 @@ class Recorder:
         stream.close()
         p.terminate()
 
-    def write(self, recording, duration):
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        if os.path.exists(lock_file):
-            print("%s - lock file %s present, skip file" % (now, lock_file))
-            return
-
-        if self.external_lock_file and os.path.exists(self.external_lock_file):
-            print("%s - external lock file %s present, skip file" % (now, self.external_lock_file))
-            return
-
-        if self.level_lock_file and os.path.exists(self.level_lock_file):
-            print("%s - level lock file %s present, skip file" % (now, self.level_lock_file))
-            return
-
-        n_files = len(os.listdir(f_name_directory))
-
-        tmp_filename = os.path.join(f_name_directory, '%s.tmp' % self.target)
-
-        wf = wave.open(tmp_filename, 'wb')
-        wf.setnchannels(self.channels)
-        wf.setsampwidth(self.p.get_sample_size(pyaudio.paInt16))
-        wf.setframerate(self.rate)
-        wf.writeframes(recording)
-        wf.close()
-        filename = os.path.join(f_name_directory, '%s.wav' % self.target)
-        os.rename(tmp_filename, filename)
-        print('%s - saved %d seconds audio to %s' % (now, duration, filename))
-
-        if self.target == 'test':
-            self.play(filename)
-
     def end(self):
     # Reset to default error handler
-        self.p.terminate()
+        if self.p is not None:
+            self.p.terminate()
         asound.snd_lib_error_set_handler(None)
 
 
 if __name__ == '__main__':
-    description = 'This script is a voice activate recorder that saves individual recording in the folder %s that is polled by sip-session to initiate an outgoing call and playback the file. The filename is in the format user@domain.wav. Use test argument to test audio level.' % f_name_directory
-    usage = '%prog [options] [user@domain]'
+    description = 'This script is a voice activate recorder that saves individual recording in the folder %s that is polled by sip-session to initiate an outgoing call and playback the file. The filename is in the format user@domain.wav. Use test argument to test audio level. Several targets can be recorded at once, each from its own device or input channel, with settings like alice@example.com:device=1,input=0,threshold=20,timeout=3 overriding the options for one target.' % f_name_directory
+    usage = '%prog [options] [user@domain[:setting=value,...] ...]'
     parser = OptionParser(usage=usage, description=description)
     parser.print_usage = parser.print_help
     os_type = platform.system()
@@ -404,28 +868,61 @@ if __name__ == '__main__':
     
     parser.add_option('-r', '--sample_rate', type='int', default='16000', dest='rate', help='Audio sample rate')
     parser.add_option('-d', '--device', type='string', default=default_device, dest='device', help='Use selected input audio device')
+    parser.add_option('-i', '--input', type='int', default=0, dest='input', help='Record the given channel of a multi-channel input device')
     parser.add_option('-T', '--timeout', type='int', default=2, dest='timeout', help='Silence timeout to stop recording')
     parser.add_option('-m', '--min_rec_time', type='int', default=1, dest='min_rec_time', help='Minimum recording time to save recording')
     parser.add_option('-M', '--max_rec_time', type='int', default=5, dest='max_rec_time', help='Maximum recording time for each file')
+    parser.add_option('-P', '--pre_roll', type='float', default=0.5, dest='pre_roll', help='Seconds of audio before the trigger included in the recording')
     parser.add_option('-t', '--threshold', type='int', default=10, dest='threshold', help='Minimum signal level to start recording')
     parser.add_option('-l', '--level_lock_file', type='string', dest='level_lock_file', help='Skip level recording if file exists')
     parser.add_option('-L', '--level_enable_file', type='string', dest='level_enable_file', help='Enable level recording only if file exists')
     parser.add_option('-e', '--external_lock_file', type='string', dest='external_lock_file', help='Skip recording if file exists')
     parser.add_option('-E', '--external_trigger_file', type='string', dest='external_trigger_file', help='Start recording if file exists, regardless of level')
+    parser.add_option('-S', '--segment_time', type='float', default=0, dest='segment_time', help='Save long recordings in parts of this many seconds, so that sip-session can play the first parts while recording goes on')
+    parser.add_option('-R', '--live_relay', action='store_true', dest='live_relay', default=False, help='Send the recordings while they are made to sip-session started with --live-relay, which plays them into a call once they are min_rec_time long')
+    parser.add_option('--replay', type='string', dest='replay', help='Read the audio from this wav file instead of an audio device and report the recordings it triggers, to tune thresholds and timeouts offline. Use the input setting to pick the channels of a multi-channel file')
+    parser.add_option('--replay_speed', type='float', default=0, dest='replay_speed', help='Replay the file at this multiple of real time (default 0, as fast as possible)')
+    parser.add_option('--replay_output', type='string', dest='replay_output', help='Directory for the recordings made during a replay (default a new temporary directory)')
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet', default=False, help='Minimize logging.')
     
     options, args = parser.parse_args()
-    try:
-        target = args[0]
-    except IndexError:
+    if not args:
         parser.print_help()
         sys.exit(1)
-    
+
+    replay = None
+    if options.replay:
+        try:
+            replay = FileStream(options.replay, options.replay_speed)
+        except (OSError, EOFError, ValueError, wave.Error) as e:
+            parser.error('cannot replay %s: %s' % (options.replay, e))
+        options.rate = replay.rate
+
+    channel_settings = {'device': str, 'input': int, 'threshold': int, 'timeout': int, 'min_rec_time': int,
+                        'max_rec_time': int, 'pre_roll': float, 'segment_time': float}
+    targets = []
+    for arg in args:
+        target, _, settings = arg.partition(':')
+        channel_options = copy.copy(options)
+        for setting in filter(None, settings.split(',')):
+            name, _, value = setting.partition('=')
+            try:
+                setattr(channel_options, name, channel_settings[name](value))
+            except KeyError:
+                parser.error('unknown setting %s for %s' % (name, target))
+            except ValueError:
+                parser.error('invalid value %s for %s of %s' % (value, name, target))
+        if replay is not None and not 0 <= channel_options.input < replay.channels:
+            parser.error('%s has only %d channels, there is no input %d for %s' % (options.replay, replay.channels, channel_options.input, target))
+        targets.append((target, channel_options))
+
+    a = None
     try:
-        a = Recorder(args[0], options)
+        a = Recorder(targets, options, replay)
         a.listen()
     except KeyboardInterrupt:
-        a.end()
+        if a is not None:
+            a.end()
         print()
         sys.exit(0)
     except OSError as e: